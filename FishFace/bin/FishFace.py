@@ -30,6 +30,7 @@ try:
     import poser
     import hopper
     import imageframe
+    import tiles
 except ImportError:
     print "Couldn't find FishFace libraries (poser.py, hopper.py, etc.)"
     raise
@@ -65,6 +66,14 @@ def main(arguments):
                         help='The area of the input image to use.  Of the form "Y_MIN x X_MIN - Y_MAX x X_MAX. Example: "0x0 - 100x200" uses only the first 200 pixels of the first 100 rows of the image.',
                         action='store')
 
+    parser.add_argument('--gray-decode', dest='grayDecode',
+                        help='Decode the images straight to grayscale.  Faster, and all that\'s needed for monochrome footage.',
+                        action='store_true')
+    parser.add_argument('--decode-scale', dest='decodeScale', type=int,
+                        metavar="SCALE", default=1, choices=(1, 2, 4, 8),
+                        help='Decode and analyze the images at 1/SCALE size (1, 2, 4 or 8).  JPEG images are shrunk by the decoder, which is much faster than decoding them at full size.  Crop boxes, skip thresholds and the kernel radius are still given in full-size pixels.',
+                        action='store')
+
     parser.add_argument('--skip-threshold', dest='skipthresh', type=int,
                         metavar="SKIP_THRESHOLD", default=1000,
                         help='After cropping, if the sum of the fish silhouette''s bounding box dimensions is larger than this, skip the image.  Setting this lower reduces false positives in fish identification, but at the cost of potentially discarding valid images.',
@@ -77,6 +86,25 @@ def main(arguments):
                         metavar="KERNEL_RADIUS", default=3,
                         help='How large should our dilation/erosion kernel be when opening/closing?',
                         action='store')
+    parser.add_argument('--pose-engine', dest='engine', type=str,
+                        metavar="ENGINE", default='rotate', choices=poser.Poser.ENGINES,
+                        help='Which method should be used to find the angle of the fish?  One of: {}.  The "moment" engine is by far the fastest.'.format(", ".join(poser.Poser.ENGINES)),
+                        action='store')
+    parser.add_argument('--batch-size', dest='batchSize', type=int,
+                        metavar="BATCH_SIZE", default=1,
+                        help='Find the angles of this many images at a time.  Anything over 1 uses the batch version of the "projection" engine, regardless of --pose-engine.',
+                        action='store')
+    parser.add_argument('--warm-start', dest='warmStart',
+                        help='Start the search for each angle near the angle found for the previous image, falling back to a full search if that looks wrong.  Much faster when the fish doesn\'t turn much between images.  Ignored when --batch-size is over 1.',
+                        action='store_true')
+    parser.add_argument('--pyramid', dest='pyramid', type=int, nargs='+',
+                        metavar="FACTOR", default=None,
+                        help='Do the coarse angle search on copies of each image shrunk by these factors (e.g. 8 2), and only the final refinement at full size.  Only used by the "rotate", "warp" and "projection" engines.',
+                        action='store')
+    parser.add_argument('--threads', dest='threads', type=int,
+                        metavar="THREADS", default=1,
+                        help='Split each large image into this many bands and clean it up on that many threads at once.  0 means one thread per CPU.',
+                        action='store')
 #    parser.add_argument('--line-thickness', dest='thickness', type=int,
 #                        metavar="THICKNESS", default=3,
 #                        help = 'How thick (in pixels) should lines be drawn.',
@@ -94,7 +122,11 @@ def main(arguments):
 
     source = (args.batchPath, args.startNum, args.stopNum)
 
-    calFrame = imageframe.Frame(args.calFile)
+    frameArgs = {'gray': args.grayDecode}
+    if args.threads != 1:
+        frameArgs['executor'] = tiles.TileExecutor(args.threads or None)
+
+    calFrame = imageframe.Frame(args.calFile, **frameArgs)
 
     preCropBox = None
     chainProcessList = []
@@ -113,36 +145,49 @@ def main(arguments):
         ('deltaImage', {'calImageFrame': calFrame}),
         ('grayImage', {}),
         ('threshold', {'threshold': args.threshold}),
-        ('closing', {'kernelRadius': args.ksize}),
-        ('opening', {'kernelRadius': args.ksize}),
+        ('closeOpen', {'kernelRadius': args.ksize}),
         ('cropToLargestBlob', {})
     ])
 
-    HC = hopper.HopperChain(source, chainProcessList)
+    # the chain decodes the images (and the calibration image) at the
+    # analysis scale and scales the crop box and kernel radius to match
+    HC = hopper.HopperChain(source, chainProcessList, recycle=True,
+                            frameArgs=frameArgs, analysisScale=args.decodeScale)
 
-    for fr in HC:
+    seedAngle = None
 
-        if fr.xdim + fr.ydim < args.skipthresh:
-            frgray = fr.copy()
-            frgray.applyGrayImage()
+    for frames in HC.batches(args.batchSize):
 
-            po = poser.Poser(frgray.array)
-            angle = po.findLongAxis()
+        # the silhouettes, moments and outlines the chain already found
+        features = []
+        for fr in frames:
+            if (fr.xdim + fr.ydim) * args.decodeScale < args.skipthresh:
+                features.append(fr.features())
 
-            #po2 = poser.Poser(frgray.array)
-            #angle2 = po2.fastFindLongAxis()
+        if args.batchSize > 1:
+            angles = iter(poser.poseBatch([feature.mask() for feature in features])[0])
+        else:
+            angles = []
+            for feature in features:
+                po = poser.Poser(feature, engine=args.engine, pyramid=args.pyramid)
+                angles.append(po.findLongAxis(seedAngle=seedAngle))
+                if args.warmStart:
+                    seedAngle = angles[-1]
+            angles = iter(angles)
 
-            if args.outfile:
-                with open(args.outfile, 'a') as f:
-                    f.write("{}: angle {}\n".format(fr.data['originalFileName'], angle))
-                    # f.write("{}: moment angle {}\n".format(fr.data['originalFileName'], angle2))
-            else:
-                print "{}: angle {}".format(fr.data['originalFileName'], angle)
-                # print "{}: moment angle {}".format(fr.data['originalFileName'], angle2)
-                # print "{} Angle diff: {}\tAngle: {}\tAngle2: {}".format(fr.data['originalFileName'], (angle-angle2+180)%360-180,angle,angle2)
+        for fr in frames:
 
-        else:
-            print "skipped {}".format(fr.data['originalFileName'])
+            if (fr.xdim + fr.ydim) * args.decodeScale < args.skipthresh:
+                angle = angles.next()
+
+                if args.outfile:
+                    with open(args.outfile, 'a') as f:
+                        f.write("{}: angle {}\n".format(fr.data['originalFileName'], angle))
+                else:
+                    print "{}: angle {}".format(fr.data['originalFileName'], angle)
+
+            else:
+                print "skipped {}".format(fr.data['originalFileName'])
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
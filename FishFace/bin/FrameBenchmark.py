@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Frame Benchmark - how fast are the Frame operations, and how much memory do
+they use?
+
+
+Example Usage
+=============
+
+python FrameBenchmark.py -o frame-benchmark.json \\
+                         --resolutions 640x480 2048x1536 \\
+                         --channels 1
+
+Time each Frame operation (delta image, threshold, closing, opening,
+skeletonize, crop to the largest blob, rotate, reading and writing files and
+copying) on synthetic single-channel images of a fish in a tank at 640x480 and
+2048x1536, and write the best and mean time, throughput, number of arrays
+drawn from the frame's buffer pool (poolDraws - arrays OpenCV and numpy make
+for themselves aren't counted) and peak memory for each as JSON to
+frame-benchmark.json.
+
+"""
+
+# system libraries
+import os
+import sys
+import json
+import argparse
+
+# add library directory to path
+sys.path.append(os.path.join(os.path.dirname(sys.path[0]), "fishface"))
+
+try:
+    import framebenchmark
+except ImportError:
+    print "Couldn't find FishFace libraries (framebenchmark.py, imageframe.py, etc.)"
+    raise
+
+
+def main(arguments):
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output-file', dest='outfile', type=str,
+                        metavar="OUTPUT_FILENAME",
+                        help='To store the results in a file instead of printing them, specify a filename here.',
+                        action='store')
+    parser.add_argument('--operations', dest='operations', type=str, nargs='+',
+                        metavar="OPERATION", default=list(framebenchmark.OPERATION_NAMES),
+                        choices=framebenchmark.OPERATION_NAMES,
+                        help='Which operations to benchmark.  Any of: {}.  All of them by default.'.format(", ".join(framebenchmark.OPERATION_NAMES)),
+                        action='store')
+    parser.add_argument('--resolutions', dest='resolutions', type=str, nargs='+',
+                        metavar="WIDTHxHEIGHT",
+                        default=['{}x{}'.format(*resolution) for resolution in framebenchmark.RESOLUTIONS],
+                        help='The image sizes to try, in pixels, like 640x480.',
+                        action='store')
+    parser.add_argument('--channels', dest='channels', type=int, nargs='+',
+                        metavar="CHANNELS", default=list(framebenchmark.CHANNELS), choices=framebenchmark.CHANNELS,
+                        help='The channel counts to try: 3 (color), 1 (grayscale) or both.',
+                        action='store')
+    parser.add_argument('--repeats', dest='repeats', type=int,
+                        metavar="COUNT", default=5,
+                        help='Time each operation this many times.',
+                        action='store')
+    parser.add_argument('--skip-memory', dest='skipMemory',
+                        help='Don\'t measure peak memory use, which means running every operation again.',
+                        action='store_true')
+
+    args = parser.parse_args(arguments)
+
+    resolutions = []
+    for resolution in args.resolutions:
+        try:
+            width, height = [int(x) for x in resolution.split("x")]
+        except ValueError:
+            raise FrameBenchmarkCLIError("I can't make sense of the resolution {}.  Try something like 640x480.".format(resolution))
+        resolutions.append((width, height))
+
+    results = framebenchmark.runBenchmark(args.operations, resolutions, args.channels,
+                                          args.repeats, not args.skipMemory)
+
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+
+class FrameBenchmarkCLIError(Exception):
+    pass
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Poser Benchmark - how well and how fast do the pose engines find the fish?
+
+
+Example Usage
+=============
+
+python PoserBenchmark.py -o poser-benchmark.json \\
+                         --sizes 60x20 120x40 240x80 \\
+                         --noise 0 0.01
+
+Make synthetic fish silhouettes facing 72 known angles, at each of three sizes
+and two noise levels, find their poses with every Poser engine (and
+fastFindLongAxis), and write the angular error, head/tail flip rate, time per
+frame and peak memory for each as JSON to poser-benchmark.json, with how many
+silhouettes each couldn't find a pose for at all (failures).  Along with
+them go a couple of consistency checks: how many answers change when a sweeping
+engine is seeded too far off to trust (warmStartMismatches), and when
+poser.poseBatch gets the silhouettes padded into a stack instead of as a list
+(poseBatchMismatches).  Both should be 0.
+
+"""
+
+# system libraries
+import os
+import sys
+import json
+import argparse
+
+# add library directory to path
+sys.path.append(os.path.join(os.path.dirname(sys.path[0]), "fishface"))
+
+try:
+    import benchmark
+except ImportError:
+    print "Couldn't find FishFace libraries (benchmark.py, poser.py, etc.)"
+    raise
+
+
+def main(arguments):
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output-file', dest='outfile', type=str,
+                        metavar="OUTPUT_FILENAME",
+                        help='To store the results in a file instead of printing them, specify a filename here.',
+                        action='store')
+    parser.add_argument('--methods', dest='methods', type=str, nargs='+',
+                        metavar="METHOD", default=list(benchmark.METHODS), choices=benchmark.METHODS,
+                        help='Which methods to benchmark.  Any of: {}.  All of them by default.'.format(", ".join(benchmark.METHODS)),
+                        action='store')
+    parser.add_argument('--angles', dest='angles', type=int,
+                        metavar="COUNT", default=72,
+                        help='How many evenly spaced angles to try at each size and noise level.',
+                        action='store')
+    parser.add_argument('--sizes', dest='sizes', type=str, nargs='+',
+                        metavar="LENGTHxWIDTH", default=['120x40'],
+                        help='The sizes of fish to try, in pixels, like 120x40.',
+                        action='store')
+    parser.add_argument('--noise', dest='noises', type=float, nargs='+',
+                        metavar="FRACTION", default=[0.0],
+                        help='The noise levels to try, as the fraction of pixels flipped at random.',
+                        action='store')
+    parser.add_argument('--repeats', dest='repeats', type=int,
+                        metavar="COUNT", default=3,
+                        help='Time each method this many times and keep the best.',
+                        action='store')
+    parser.add_argument('--skip-memory', dest='skipMemory',
+                        help='Don\'t measure peak memory use, which means running every method again.',
+                        action='store_true')
+
+    args = parser.parse_args(arguments)
+
+    sizes = []
+    for size in args.sizes:
+        try:
+            length, width = [int(x) for x in size.split("x")]
+        except ValueError:
+            raise PoserBenchmarkCLIError("I can't make sense of the size {}.  Try something like 120x40.".format(size))
+        sizes.append((length, width))
+
+    results = benchmark.runBenchmark(args.methods, args.angles, sizes, args.noises,
+                                     args.repeats, not args.skipMemory)
+
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+
+class PoserBenchmarkCLIError(Exception):
+    pass
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -243,7 +243,7 @@ class FFiPySupport:
 
         return [None, None]
 
-    def analyzeExperiment(self, expDirIdx, calPrefix, dataPrefix, threshold, outFilenamePrefix=None, poiContours=None):
+    def analyzeExperiment(self, expDirIdx, calPrefix, dataPrefix, threshold, outFilenamePrefix=None, poiContours=None, warmStart=False, analysisScale=1):
         experimentDir = self.dataDirs[expDirIdx]
         print experimentDir
         if not os.path.exists(experimentDir):
@@ -282,14 +282,15 @@ class FFiPySupport:
             ('deltaImage', {'calImageFrame': calFrame}),
             ('grayImage', {}),
             ('threshold', {'threshold': threshold}),
-            ('closing', {'kernelRadius': 3}),
-            ('opening', {'kernelRadius': 3}),
+            ('closeOpen', {'kernelRadius': 3}),
             ('cropToLargestBlob', {}),
             ('findCentroid', {})
         ]
 
         self.msg("Building hopper chain.")
-        HC = hopper.HopperChain(dataFiles, chainProcessList)
+        # With an analysisScale, the images are analyzed at 1/analysisScale
+        # size, but the positions still come out in full-size pixels.
+        HC = hopper.HopperChain(dataFiles, chainProcessList, analysisScale=analysisScale)
 
         self.msg("Starting hopper chain.")
 
@@ -324,10 +325,16 @@ class FFiPySupport:
 
         firstFrameTimestamp = None
 
+        # consecutive images are close together in time, so each angle search
+        # can start from the last angle found
+        seedAngle = None
+
         for fr in HC:
 
-            po = poser.Poser(fr.array)
-            angle = po.findLongAxis()
+            po = poser.Poser(fr.features())
+            angle = po.findLongAxis(seedAngle=seedAngle)
+            if warmStart:
+                seedAngle = angle
             position = fr.data['absoluteCentroid']
             if poiContours is not None:
                 poiScore = cv2.pointPolygonTest(poiContours[0],position,True)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+The arraycache module provides arraycache.ArrayCache, a dictionary-like store
+for numpy arrays that stays within a memory budget by throwing out the least
+recently used arrays.
+"""
+
+import copy
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    print "The arraycache module needs numpy."
+    raise
+
+
+def packArray(array):
+    """Squeeze a binary (zero/nonzero) array down to one bit per element.
+    Returns a tuple that unpackArray can turn back into a 0/255 uint8 array."""
+    return (np.packbits(array != 0, axis=None), array.shape)
+
+
+def unpackArray(packed):
+    """Undo packArray.  Nonzero elements come back as 255."""
+    bits, shape = packed
+    size = int(np.prod(shape))
+    array = np.unpackbits(bits)[:size].reshape(shape)
+    array *= 255
+    return array
+
+
+class ArrayCache:
+    """
+A least-recently-used cache of numpy arrays with a byte budget.  It acts like a
+dictionary, so it can stand in for the plain dicts that used to hold cached
+arrays.  Things to know:
+    * Storing an array that would push the total over maxBytes throws out the
+      least recently used arrays until it fits.  An array larger than the whole
+      budget isn't stored at all.
+    * With packBits=True, arrays are stored one bit per element (see packArray)
+      and come back as 0/255 uint8 arrays.  Only use this for binary images.
+    * get() keeps count of hits and misses; evictions are counted too.  See
+      stats().
+"""
+
+    def __init__(self, maxBytes=64 * 2 ** 20, packBits=False):
+        self.maxBytes = maxBytes
+        self.packBits = packBits
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entryBytes(self, entry):
+        if self.packBits:
+            return entry[0].nbytes
+        return entry.nbytes
+
+    def get(self, key, default=None):
+        """Return the array stored under key (marking it as recently used), or
+        default if there isn't one."""
+        if key in self.entries:
+            self.hits += 1
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            if self.packBits:
+                return unpackArray(entry)
+            return entry
+
+        self.misses += 1
+        return default
+
+    def __getitem__(self, key):
+        array = self.get(key)
+        if array is None:
+            raise KeyError(key)
+        return array
+
+    def __setitem__(self, key, array):
+        if key in self.entries:
+            del self[key]
+
+        if self.packBits:
+            entry = packArray(array)
+        else:
+            entry = array
+
+        size = self._entryBytes(entry)
+        if size > self.maxBytes:
+            self.evictions += 1
+            return
+
+        while self.entries and self.nbytes + size > self.maxBytes:
+            oldKey, oldEntry = self.entries.popitem(last=False)
+            self.nbytes -= self._entryBytes(oldEntry)
+            self.evictions += 1
+
+        self.entries[key] = entry
+        self.nbytes += size
+
+    def __delitem__(self, key):
+        self.nbytes -= self._entryBytes(self.entries.pop(key))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def update(self, pairs):
+        for key, array in pairs:
+            self[key] = array
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache counters and current usage."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'nbytes': self.nbytes,
+            'maxBytes': self.maxBytes
+        }
+
+    def __deepcopy__(self, memodic=None):
+        newCache = ArrayCache(self.maxBytes, self.packBits)
+        newCache.entries = copy.deepcopy(self.entries, memodic)
+        newCache.nbytes = self.nbytes
+        return newCache
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+The arrayhistory module provides arrayhistory.ArrayHistory, the list of
+preserved arrays a Frame keeps (see Frame.preserveArray).  It holds a limited
+number of arrays within a byte budget, throwing out the oldest ones first, and
+can keep them compressed.
+"""
+
+import zlib
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    print "The arrayhistory module needs numpy."
+    raise
+
+from arraycache import packArray, unpackArray
+
+COMPRESSIONS = (None, 'zlib', 'bits', 'auto')
+
+# zlib level 1 gets most of the way on images like ours at a fraction of the
+# time the higher levels take.
+ZLIB_LEVEL = 1
+
+# The defaults for a Frame's history.
+DEPTH = 8
+MAX_BYTES = 64 * 2 ** 20
+
+
+def isBinary(array):
+    """True if every element of the uint8 array is 0 or 255."""
+    if array.dtype != np.uint8:
+        return False
+    counts = np.bincount(array.ravel(), minlength=256)
+    return counts[0] + counts[255] == array.size
+
+
+class ArrayHistory:
+    """
+A ring buffer of arrays, oldest first, that acts enough like a list for the
+code that used to keep preserved arrays in one: append, len, indexing
+(negative indices too) and iteration.  Things to know:
+    * append() stores a copy, so the array can go on being changed afterward.
+    * At most depth arrays are kept, and no more than maxBytes (as stored).
+      Appending past either limit throws out the oldest arrays until it fits.
+      An array larger than the whole budget isn't stored at all.
+    * compression decides how the arrays are stored:
+        None - as plain arrays (fastest; the default)
+        'zlib' - zlib-compressed
+        'bits' - bit-packed, one bit per element; only for binary images,
+                 which come back as 0/255 uint8 arrays
+        'auto' - bit-packed if the array is binary (0/255 uint8), zlib otherwise
+      Compressed arrays are only decompressed when they're asked for, and a new
+      array is made every time.  Plain arrays are handed back as they are, so
+      don't change them.
+    * Compressed entries never change, so copies of an ArrayHistory share
+      them; plain ones are copied.
+    * With a bufferpool.BufferPool, plain arrays are taken from the pool and
+      given back when they're thrown out or cleared.
+"""
+
+    def __init__(self, depth=DEPTH, maxBytes=MAX_BYTES, compression=None, pool=None):
+        if compression not in COMPRESSIONS:
+            raise ArrayHistoryError("I don't know the compression {}.  Try one of: {}".format(compression, COMPRESSIONS))
+
+        self.depth = depth
+        self.maxBytes = maxBytes
+        self.compression = compression
+        self.pool = pool
+        # each entry is (kind, stored, nbytes, shape, dtype)
+        self.entries = collections.deque()
+        self.nbytes = 0
+        self.evictions = 0
+
+    def _store(self, array):
+        kind = self.compression
+        if kind == 'auto':
+            kind = 'bits' if isBinary(array) else 'zlib'
+
+        if kind is None:
+            if self.pool is None:
+                stored = np.empty(array.shape, array.dtype)
+            else:
+                stored = self.pool.take(array.shape, array.dtype)
+            np.copyto(stored, array)
+            size = stored.nbytes
+        elif kind == 'bits':
+            stored = packArray(array)
+            stored[0].flags.writeable = False
+            size = stored[0].nbytes
+        else:
+            stored = zlib.compress(np.ascontiguousarray(array).tostring(), ZLIB_LEVEL)
+            size = len(stored)
+
+        return (kind, stored, size, array.shape, array.dtype)
+
+    def _load(self, entry):
+        kind, stored, _, shape, dtype = entry
+        if kind is None:
+            return stored
+        if kind == 'bits':
+            return unpackArray(stored)
+        return np.frombuffer(zlib.decompress(stored), dtype).reshape(shape).copy()
+
+    def _giveBack(self, entry):
+        if entry[0] is None and self.pool is not None:
+            self.pool.give(entry[1])
+
+    def append(self, array):
+        """Store a copy of array as the newest entry."""
+        entry = self._store(array)
+        if entry[2] > self.maxBytes or self.depth < 1:
+            self._giveBack(entry)
+            self.evictions += 1
+            return
+
+        while self.entries and (len(self.entries) >= self.depth or
+                                self.nbytes + entry[2] > self.maxBytes):
+            oldEntry = self.entries.popleft()
+            self.nbytes -= oldEntry[2]
+            self._giveBack(oldEntry)
+            self.evictions += 1
+
+        self.entries.append(entry)
+        self.nbytes += entry[2]
+
+    def __getitem__(self, index):
+        return self._load(self.entries[index])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        for entry in self.entries:
+            yield self._load(entry)
+
+    def clear(self):
+        """Throw out every entry, giving plain arrays back to the pool."""
+        for entry in self.entries:
+            self._giveBack(entry)
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Returns a dictionary of the history counters and current usage."""
+        return {
+            'entries': len(self.entries),
+            'evictions': self.evictions,
+            'nbytes': self.nbytes,
+            'depth': self.depth,
+            'maxBytes': self.maxBytes,
+            'compression': self.compression
+        }
+
+    def __copy__(self):
+        return self.__deepcopy__()
+
+    # the pool stays behind when pickled
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __deepcopy__(self, memodic=None):
+        newHistory = ArrayHistory(self.depth, self.maxBytes, self.compression, self.pool)
+        for entry in self.entries:
+            if entry[0] is None:
+                entry = (None, entry[1].copy()) + entry[2:]
+            newHistory.entries.append(entry)
+        newHistory.nbytes = self.nbytes
+        newHistory.evictions = self.evictions
+        return newHistory
+
+
+class ArrayHistoryError(Exception):
+    pass
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""
+The benchmark module measures how well the Poser engines find the pose of
+synthetic fish whose angles are known: how far off the answers are, how often
+the head and tail get swapped, how long each silhouette takes and how much
+memory is used.  bin/PoserBenchmark.py runs it from the command line.
+"""
+
+import os
+import math
+import timeit
+import multiprocessing
+
+try:
+    import numpy as np
+    import cv2
+except ImportError:
+    print "The benchmark module needs numpy and OpenCV."
+    raise
+
+# tracemalloc is in the standard library from Python 3.4 (and can be installed
+# as pytracemalloc before that).  Without it, peak memory is measured from the
+# resident set size of a child process instead, which needs Linux's /proc.
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Writing 5 here resets the process's peak resident set size (Linux 4.0 on).
+CLEAR_REFS = '/proc/self/clear_refs'
+PROC_STATUS = '/proc/self/status'
+
+# glibc's malloc_trim hands memory that's been freed back to the system.
+try:
+    import ctypes
+    import ctypes.util
+    LIBC = ctypes.CDLL(ctypes.util.find_library('c'))
+    LIBC.malloc_trim
+except (ImportError, OSError, AttributeError, TypeError):
+    LIBC = None
+
+import poser
+
+# Anything further off than this is counted as the head and tail being swapped.
+FLIP_ERROR = 90
+
+# Every Poser engine, plus the old quick method.
+METHODS = poser.Poser.ENGINES + ('fastFindLongAxis',)
+
+# The engines that sweep candidate angles, and so can be seeded with the last
+# answer; and how far off the seed is when checking that a seed too far off
+# to trust falls back to the full sweep.
+SEEDED_METHODS = ('rotate', 'warp', 'projection')
+SEED_ERROR = 30
+
+
+def syntheticFish(angle, length=120, width=40, noise=0.0, seed=0):
+    """A binary (0/255) silhouette of a fish facing angle degrees, in the
+    findLongAxis convention (0 is toward the right of the image and angles go
+    counterclockwise).  The head is a fat ellipse, the tail a tapering wedge
+    behind it.  With noise, that fraction of the pixels is flipped at random.
+    The silhouette is cropped to its bounding box, the way
+    Frame.applyCropToLargestBlob leaves it."""
+    size = int(length * 1.6)
+    array = np.zeros((size, size), np.uint8)
+
+    middle = size / 2.0
+    rad = math.radians(angle)
+    forward = np.array([math.cos(rad), -math.sin(rad)])
+    sideways = np.array([forward[1], -forward[0]])
+
+    head = middle + forward * length * 0.15
+    cv2.ellipse(array, (int(head[0]), int(head[1])), (int(length * 0.35), width // 2),
+                -angle, 0, 360, 255, -1)
+
+    tail = middle - forward * length * 0.45
+    points = np.array([middle + sideways * width * 0.25,
+                       tail + sideways * width * 0.05,
+                       tail - sideways * width * 0.05,
+                       middle - sideways * width * 0.25]).astype(np.int32)
+    cv2.fillConvexPoly(array, points, 255)
+
+    if noise:
+        flips = np.random.RandomState(seed).rand(*array.shape) < noise
+        array[flips] ^= 255
+
+    ys, xs = np.nonzero(array)
+    return array[ys.min():ys.max() + 1, xs.min():xs.max() + 1].copy()
+
+
+def angleError(found, truth):
+    """The signed difference between two angles, in [-180,180)."""
+    return (found - truth + 180) % 360 - 180
+
+
+def findPose(method, silhouette):
+    """Find the pose of a silhouette with the named method (a Poser engine or
+    'fastFindLongAxis') and return the angle in the findLongAxis convention."""
+    if method == 'fastFindLongAxis':
+        # fastFindLongAxis gives the angle in [0,360) toward the tail, so turn
+        # it around and bring it into [-180,180)
+        angle = poser.Poser(silhouette).fastFindLongAxis()
+        return (angle + 180 + 180) % 360 - 180
+    return poser.Poser(silhouette, engine=method).findLongAxis()
+
+
+def tryPose(method, silhouette):
+    """findPose, but None if the method fails on the silhouette, so one bad
+    case doesn't stop the whole benchmark."""
+    try:
+        return findPose(method, silhouette)
+    except Exception:
+        return None
+
+
+def makeCases(angles=36, sizes=((120, 40),), noises=(0.0,)):
+    """A list of (angle, length, width, noise, silhouette) tuples: angles
+    evenly spaced angles (offset a little so they don't all land on whole
+    degrees) for each size and noise level."""
+    cases = []
+    for length, width in sizes:
+        for noise in noises:
+            for i in range(angles):
+                angle = (360.0 * i / angles + 0.37 * i) % 360 - 180
+                silhouette = syntheticFish(angle, length, width, noise, seed=i)
+                cases.append((angle, length, width, noise, silhouette))
+    return cases
+
+
+def timePoses(method, cases, repeats=1):
+    """Find the pose of every case with the method.  Returns the answers (None
+    where the method failed) and the best time per silhouette (in seconds)
+    over repeats runs."""
+    best = None
+    for repeat in range(repeats):
+        start = timeit.default_timer()
+        answers = [tryPose(method, case[-1]) for case in cases]
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return answers, best / max(1, len(cases))
+
+
+def residentSetSizes():
+    """This process's (current, peak) resident set size in bytes, from
+    /proc."""
+    sizes = dict()
+    with open(PROC_STATUS) as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                # e.g. "VmRSS:    22488 kB"
+                sizes[line[:5]] = int(line.split()[1]) * 1024
+    return sizes['VmRSS'], sizes['VmHWM']
+
+
+def resetPeakResidentSetSize():
+    """Bring the peak resident set size down to the current one.  Returns
+    False if that can't be done here."""
+    try:
+        with open(CLEAR_REFS, 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _childPeak(run, setup, connection):
+    try:
+        state = setup() if setup is not None else None
+        # A forked child starts out with its parent's peak, and with memory
+        # the parent freed still resident, where new arrays would go without
+        # adding to the resident set size.  So hand that memory back, and
+        # measure from a fresh peak and the size left.
+        LIBC.malloc_trim(0)
+        if not resetPeakResidentSetSize():
+            connection.send(None)
+            return
+        before = residentSetSizes()[0]
+        run(state)
+        connection.send(max(0, residentSetSizes()[1] - before))
+    finally:
+        connection.close()
+
+
+def peakMemoryOf(run, setup=None):
+    """The most memory (in bytes) used at once by run(state), where state is
+    what setup() returns (or None), or None if there's no way to tell on this
+    system.  What setup uses isn't counted.
+
+    tracemalloc counts the allocations themselves, numpy arrays included.
+    Without it, setup and run are run in a fresh child process, and the
+    child's peak resident set size while running, less its size just before,
+    is reported.  It counts whole pages, and memory OpenCV and numpy set up
+    the first time they're used in the process as well, so setup should do
+    what run does once first."""
+    if tracemalloc is not None:
+        state = setup() if setup is not None else None
+        tracemalloc.start()
+        try:
+            run(state)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    if memoryMethod() is None:
+        return None
+
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_childPeak, args=(run, setup, child))
+    process.start()
+    # only the child writes, so if it dies recv gives up instead of waiting
+    child.close()
+    try:
+        peak = parent.recv()
+    except EOFError:
+        raise BenchmarkError("The process measuring peak memory died before it was done.")
+    finally:
+        process.join()
+    return peak
+
+
+def memoryMethod():
+    """How peakMemoryOf measures memory here: 'tracemalloc', 'rss' (the
+    resident set size of a child process) or None."""
+    if tracemalloc is not None:
+        return 'tracemalloc'
+    if LIBC is not None and os.path.exists(CLEAR_REFS) and os.path.exists(PROC_STATUS):
+        return 'rss'
+    return None
+
+
+def peakMemory(method, cases):
+    """The most memory (in bytes) used at once while finding the pose of every
+    case with the method, or None if there's no way to tell on this system.
+    See peakMemoryOf."""
+    def setup():
+        silhouettes = [case[-1] for case in cases]
+        tryPose(method, silhouettes[0])
+        return silhouettes
+
+    def run(silhouettes):
+        for silhouette in silhouettes:
+            tryPose(method, silhouette)
+    return peakMemoryOf(run, setup)
+
+
+def warmStartMismatches(method, cases, seedError=SEED_ERROR):
+    """How many cases get a different answer from findLongAxis seeded
+    seedError degrees off (further than its window reaches) than from the
+    full sweep, or None for the methods that can't be seeded.  The narrow
+    search should notice that the answer is outside its window and fall back
+    to the full sweep, so this should be 0."""
+    if method not in SEEDED_METHODS:
+        return None
+
+    mismatches = 0
+    for case in cases:
+        full = poser.Poser(case[-1], engine=method).findLongAxis()
+        seeded = poser.Poser(case[-1], engine=method).findLongAxis(seedAngle=case[0] + seedError)
+        if seeded != full:
+            mismatches += 1
+    return mismatches
+
+
+def poseBatchMismatches(cases, padding=8, seed=0):
+    """How many cases poser.poseBatch answers differently when the silhouettes
+    are padded out into one stack, each at a random spot, than when they're
+    given as a list.  Padding shouldn't move anything, so this should be 0."""
+    silhouettes = [case[-1] for case in cases]
+    if not silhouettes:
+        return 0
+
+    height = max(silhouette.shape[0] for silhouette in silhouettes) + padding
+    width = max(silhouette.shape[1] for silhouette in silhouettes) + padding
+    stack = np.zeros((len(silhouettes), height, width), np.uint8)
+    rs = np.random.RandomState(seed)
+    for layer, silhouette in zip(stack, silhouettes):
+        top = rs.randint(0, height - silhouette.shape[0] + 1)
+        left = rs.randint(0, width - silhouette.shape[1] + 1)
+        layer[top:top + silhouette.shape[0], left:left + silhouette.shape[1]] = silhouette
+
+    listed = poser.poseBatch(silhouettes)[0]
+    stacked = poser.poseBatch(stack)[0]
+    return int(np.sum(listed != stacked))
+
+
+def summarize(method, cases, answers, secondsPerFrame, peakBytes):
+    """Boils the answers for one method down to a dictionary of results.
+    Errors are in degrees; the axis error ignores head/tail swaps.  Cases the
+    method failed on (answered None) are counted as failures and left out of
+    the errors, which are None if it failed on all of them."""
+    errors = np.array([angleError(answer, case[0]) for answer, case in zip(answers, cases)
+                       if answer is not None])
+    magnitudes = np.abs(errors)
+    flipped = magnitudes > FLIP_ERROR
+    axisErrors = np.where(flipped, 180 - magnitudes, magnitudes)
+
+    def stat(f, values):
+        return float(f(values)) if len(values) else None
+
+    return {
+        'method': method,
+        'frames': len(cases),
+        'failures': len(cases) - len(errors),
+        'meanError': stat(np.mean, axisErrors),
+        'medianError': stat(np.median, axisErrors),
+        'maxError': stat(np.max, axisErrors),
+        'flipRate': stat(np.mean, flipped),
+        'secondsPerFrame': secondsPerFrame,
+        'peakMemoryBytes': peakBytes
+    }
+
+
+def runBenchmark(methods=METHODS, angles=36, sizes=((120, 40),), noises=(0.0,),
+                 repeats=1, measureMemory=True):
+    """Runs every method against the same synthetic fish and returns a
+    dictionary with the settings, a list of results, one for each method at
+    each size and noise level (see summarize), and a list of consistency
+    checks for each size and noise level, ready to be dumped as JSON."""
+    results = []
+    checks = []
+    for length, width in sizes:
+        for noise in noises:
+            cases = makeCases(angles, [(length, width)], [noise])
+            checks.append({'length': length, 'width': width, 'noise': noise,
+                           'poseBatchMismatches': poseBatchMismatches(cases)})
+            for method in methods:
+                answers, secondsPerFrame = timePoses(method, cases, repeats)
+                peakBytes = peakMemory(method, cases) if measureMemory else None
+                result = summarize(method, cases, answers, secondsPerFrame, peakBytes)
+                result.update({'length': length, 'width': width, 'noise': noise,
+                               'warmStartMismatches': warmStartMismatches(method, cases)})
+                results.append(result)
+
+    return {
+        'settings': {
+            'methods': list(methods),
+            'angles': angles,
+            'sizes': [list(size) for size in sizes],
+            'noises': list(noises),
+            'repeats': repeats,
+            'memoryMethod': memoryMethod() if measureMemory else None
+        },
+        'results': results,
+        'checks': checks
+    }
+
+
+class BenchmarkError(Exception):
+    pass
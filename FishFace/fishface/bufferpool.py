@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+The bufferpool module provides bufferpool.BufferPool, a store of spare numpy
+arrays that image operations can draw their scratch and output arrays from and
+give back when they're done, instead of allocating new ones for every frame.
+"""
+
+try:
+    import numpy as np
+except ImportError:
+    print "The bufferpool module needs numpy."
+    raise
+
+
+class BufferPool:
+    """
+A pool of spare numpy arrays, kept by shape and dtype.  Things to know:
+    * take() hands out a spare array of the requested shape and dtype if there
+      is one, or a new (uninitialized) one if there isn't.  Either way, the
+      contents are garbage.
+    * give() puts an array back for someone else to use.  Only give back arrays
+      that nothing else refers to any more; the pool can't tell.  Arrays that
+      are views of other arrays are ignored, as are arrays that would push the
+      pool past maxBytes or past maxPerKey spares of the same shape and dtype.
+    * take() keeps count of reuses and allocations; see stats().
+"""
+
+    def __init__(self, maxBytes=64 * 2 ** 20, maxPerKey=4):
+        self.maxBytes = maxBytes
+        self.maxPerKey = maxPerKey
+        self.spares = dict()
+        self.nbytes = 0
+        self.reuses = 0
+        self.allocations = 0
+        self.discards = 0
+
+    def _key(self, shape, dtype):
+        return (tuple(shape), np.dtype(dtype).str)
+
+    def take(self, shape, dtype=np.uint8):
+        """Returns an array of the given shape and dtype, reusing a spare one if
+        possible."""
+        spares = self.spares.get(self._key(shape, dtype))
+        if spares:
+            array = spares.pop()
+            self.nbytes -= array.nbytes
+            self.reuses += 1
+            return array
+
+        self.allocations += 1
+        return np.empty(shape, dtype)
+
+    def give(self, array):
+        """Puts array in the pool to be handed out again by take()."""
+        if array is None:
+            return
+
+        if (array.base is not None or not array.flags['C_CONTIGUOUS']
+                or self.nbytes + array.nbytes > self.maxBytes):
+            self.discards += 1
+            return
+
+        spares = self.spares.setdefault(self._key(array.shape, array.dtype), [])
+        if len(spares) >= self.maxPerKey or any(spare is array for spare in spares):
+            self.discards += 1
+            return
+
+        spares.append(array)
+        self.nbytes += array.nbytes
+
+    def clear(self):
+        self.spares.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Returns a dictionary of the pool counters and current usage."""
+        return {
+            'reuses': self.reuses,
+            'allocations': self.allocations,
+            'discards': self.discards,
+            'spares': sum(len(spares) for spares in self.spares.values()),
+            'nbytes': self.nbytes,
+            'maxBytes': self.maxBytes
+        }
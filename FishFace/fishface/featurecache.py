@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+The featurecache module provides featurecache.FeatureCache, which works out
+the geometry of a silhouette (its mask, moments, outline, etc.) when it's first
+asked for and remembers it, so that the Frame stages, the Poser and Poseidon
+can share it instead of each working it out again.  See Frame.features.
+"""
+
+try:
+    import numpy as np
+    import cv2
+except ImportError:
+    print "The featurecache module needs numpy and OpenCV."
+    raise
+
+
+class FeatureCache:
+    """
+The features of one single-channel array, each worked out once, the first
+time it's asked for:
+    mask() - the silhouette: 255 wherever the array isn't zero, 0 elsewhere
+    count() - how many pixels are in the silhouette
+    moments() - the image moments of the silhouette (so m00 is the count)
+    contours() - the outer outlines of all the blobs in the silhouette
+    largestContour() - the outline with the largest area
+    boundingRect() - (x, y, width, height) around the whole silhouette
+    columnCounts() - how many silhouette pixels are in each column
+
+The cache belongs to one state of one array; whoever changes the array must
+stop using it (Frame.features hands out a new one when its array changes).
+Nothing handed out should be changed.  A feature that's already known, e.g.
+an outline that came from a larger image, can be filled in with store().
+"""
+
+    FEATURES = ('mask', 'count', 'moments', 'contours', 'largestContour',
+                'boundingRect', 'columnCounts')
+
+    def __init__(self, array):
+        if array.ndim != 2:
+            raise FeatureCacheError("I can only find the features of single-channel images, but I see {} dimensions.".format(array.ndim))
+
+        self.array = array
+        self.known = dict()
+        self.computed = dict((name, 0) for name in self.FEATURES)
+
+    def feature(self, name, compute):
+        if name not in self.known:
+            self.known[name] = compute()
+            self.computed[name] += 1
+        return self.known[name]
+
+    def store(self, name, value):
+        """Fill in a feature that's already known."""
+        if name not in self.FEATURES:
+            raise FeatureCacheError("I don't know the feature {}.  Try one of: {}".format(name, ", ".join(self.FEATURES)))
+        self.known[name] = value
+
+    def mask(self):
+        def compute():
+            return cv2.threshold(self.array, 0, 255, cv2.THRESH_BINARY)[1]
+        return self.feature('mask', compute)
+
+    def count(self):
+        if 'moments' in self.known:
+            return int(self.known['moments']['m00'])
+        return self.feature('count', lambda: cv2.countNonZero(self.array))
+
+    def moments(self):
+        return self.feature('moments', lambda: cv2.moments(self.array, binaryImage=True))
+
+    def contours(self):
+        def compute():
+            # findContours returns two or three things depending on the
+            # version of OpenCV; the contours are always second from the end
+            return cv2.findContours(self.array.copy(), mode=cv2.RETR_EXTERNAL,
+                                    method=cv2.CHAIN_APPROX_SIMPLE)[-2]
+        return self.feature('contours', compute)
+
+    def largestContour(self):
+        """The largest outline, or None if there are no blobs at all."""
+        def compute():
+            contours = self.contours()
+            if not len(contours):
+                return None
+            areas = [cv2.contourArea(contour) for contour in contours]
+            return contours[areas.index(max(areas))]
+        return self.feature('largestContour', compute)
+
+    def boundingRect(self):
+        return self.feature('boundingRect', lambda: cv2.boundingRect(self.array))
+
+    def columnCounts(self):
+        def compute():
+            sums = cv2.reduce(self.mask(), 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S)[0]
+            return sums // 255
+        return self.feature('columnCounts', compute)
+
+    def stats(self):
+        """How many times each feature has been worked out (never more than
+        once; stored features don't count)."""
+        return dict(self.computed)
+
+
+class FeatureCacheError(Exception):
+    pass
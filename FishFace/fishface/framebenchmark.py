@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+The framebenchmark module times the imageframe.Frame operations on synthetic
+images at the resolutions we actually record at, and counts the arrays and
+peak memory each one uses, so that the slow ones stand out and slowdowns get
+noticed.  bin/FrameBenchmark.py runs it from the command line.
+"""
+
+import os
+import shutil
+import tempfile
+import timeit
+
+try:
+    import numpy as np
+    import cv2
+except ImportError:
+    print "The framebenchmark module needs numpy and OpenCV."
+    raise
+
+import benchmark
+import bufferpool
+import imageframe
+
+# (width, height) of the cameras' images
+RESOLUTIONS = ((640, 480), (1600, 1200), (2048, 1536))
+CHANNELS = (3, 1)
+
+# The fish is about this fraction of the width of the image long.
+FISH_LENGTH = 0.15
+
+
+class Scene:
+    """
+The images the operations are timed on, at one resolution and channel count:
+    cal - the empty tank
+    frame - the tank with a fish in it
+    binary - frame after the usual delta/threshold/closeOpen cleanup
+    mask - binary with as many channels as frame, for the operations that
+           work on any number of channels
+    blob - binary cropped to the fish
+    filename - frame, saved as a JPEG
+    directory - where to save things (deleted by cleanup())
+"""
+
+    def __init__(self, width, height, channels, seed=0):
+        rs = np.random.RandomState(seed)
+
+        # a smooth, lumpy background, the same in both images
+        small = rs.randint(40, 200, (max(2, height // 32), max(2, width // 32), channels)).astype(np.uint8)
+        background = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+        background = background.reshape((height, width, channels))
+
+        length = max(20, int(width * FISH_LENGTH))
+        fish = benchmark.syntheticFish(30, length, length // 3)
+        top = (height - fish.shape[0]) // 2
+        left = (width - fish.shape[1]) // 2
+
+        image = background.copy()
+        region = image[top:top + fish.shape[0], left:left + fish.shape[1]]
+        region[fish > 0] = 20
+
+        if channels == 1:
+            background = background[:, :, 0]
+            image = image[:, :, 0]
+
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.cal = imageframe.Frame(background)
+        self.frame = imageframe.Frame(image)
+
+        self.binary = self.frame.copy()
+        self.binary.applyDeltaImage({'calImageFrame': self.cal})
+        self.binary.applyGrayImage()
+        self.binary.applyThreshold({'threshold': 35})
+        self.binary.applyCloseOpen({'kernelRadius': 3})
+
+        if channels == 1:
+            self.mask = self.binary
+        else:
+            self.mask = imageframe.Frame(cv2.merge([self.binary.array] * channels))
+
+        self.blob = self.binary.copy()
+        self.blob.applyCropToLargestBlob()
+
+        self.directory = tempfile.mkdtemp(prefix='framebenchmark-')
+        self.filename = os.path.join(self.directory, 'frame.jpg')
+        self.frame.saveImageToFile(self.filename)
+
+    def fresh(self, name, pool):
+        """A new Frame with a copy of one of my images, drawing its arrays
+        from pool."""
+        return imageframe.Frame(getattr(self, name).array, pool=pool)
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# The setup for each operation makes whatever the operation needs from the
+# scene, untimed, and returns a function that does the operation itself.
+
+def _deltaImage(scene, pool):
+    frame = scene.fresh('frame', pool)
+    return lambda: frame.applyDeltaImage({'calImageFrame': scene.cal})
+
+
+def _threshold(scene, pool):
+    frame = scene.fresh('frame', pool)
+    return lambda: frame.applyThreshold({'threshold': 35})
+
+
+def _closing(scene, pool):
+    frame = scene.fresh('mask', pool)
+    return lambda: frame.applyClosing({'kernelRadius': 3})
+
+
+def _opening(scene, pool):
+    frame = scene.fresh('mask', pool)
+    return lambda: frame.applyOpening({'kernelRadius': 3})
+
+
+def _skeletonize(scene, pool):
+    frame = scene.fresh('blob', pool)
+    return lambda: frame.applySkeletonize({})
+
+
+def _zhangSuen(scene, pool):
+    frame = scene.fresh('blob', pool)
+    return lambda: frame.applySkeletonize({'method': 'zhangSuen'})
+
+
+def _autoSkeleton(scene, pool):
+    frame = scene.fresh('blob', pool)
+    return lambda: frame.applySkeletonize({'method': 'auto'})
+
+
+def _cropToLargestBlob(scene, pool):
+    frame = scene.fresh('binary', pool)
+    return lambda: frame.applyCropToLargestBlob()
+
+
+def _rotate(scene, pool):
+    frame = scene.fresh('frame', pool)
+    return lambda: frame.applyRotate({'angleDegrees': 30})
+
+
+def _setImageFromFile(scene, pool):
+    frame = imageframe.Frame(scene.frame.array, pool=pool, gray=scene.channels == 1)
+    return lambda: frame.setImageFromFile(scene.filename)
+
+
+def _saveImageToFile(scene, pool):
+    frame = scene.fresh('frame', pool)
+    return lambda: frame.saveImageToFile(os.path.join(scene.directory, 'saved.jpg'))
+
+
+def _copy(scene, pool):
+    return scene.fresh('frame', pool).copy
+
+
+# (name, channel counts it works on, setup)
+OPERATIONS = [
+    ('applyDeltaImage', CHANNELS, _deltaImage),
+    ('applyThreshold', CHANNELS, _threshold),
+    ('applyClosing', CHANNELS, _closing),
+    ('applyOpening', CHANNELS, _opening),
+    ('applySkeletonize', (1,), _skeletonize),
+    ('applySkeletonize:zhangSuen', (1,), _zhangSuen),
+    ('applySkeletonize:auto', (1,), _autoSkeleton),
+    ('applyCropToLargestBlob', (1,), _cropToLargestBlob),
+    ('applyRotate', CHANNELS, _rotate),
+    ('setImageFromFile', CHANNELS, _setImageFromFile),
+    ('saveImageToFile', CHANNELS, _saveImageToFile),
+    ('copy', CHANNELS, _copy)
+]
+
+OPERATION_NAMES = [operation[0] for operation in OPERATIONS]
+
+
+def warmedUp(setup, scene):
+    """A setup for benchmark.peakMemoryOf that runs the operation once first,
+    so what OpenCV sets up the first time isn't counted."""
+    def prepare():
+        setup(scene, None)()
+        return setup(scene, None)
+    return prepare
+
+
+def timeOperation(setup, scene, repeats):
+    """Run the operation repeats times, each on freshly set up frames.
+    Returns the best and mean time (in seconds) and the number of arrays the
+    operation drew from the Frame's buffer pool the first time.  The pool
+    starts with nothing to spare, so that's every Frame.newArray, but only
+    those: arrays OpenCV or numpy make for themselves aren't counted, so it's
+    not the number of allocations (peakMemoryOf sees those)."""
+    times = []
+    poolDraws = None
+    for repeat in range(repeats):
+        pool = bufferpool.BufferPool()
+        run = setup(scene, pool)
+        before = pool.allocations
+
+        start = timeit.default_timer()
+        run()
+        times.append(timeit.default_timer() - start)
+
+        if poolDraws is None:
+            poolDraws = pool.allocations - before
+
+    return min(times), sum(times) / len(times), poolDraws
+
+
+def runBenchmark(operations=OPERATION_NAMES, resolutions=RESOLUTIONS, channels=CHANNELS,
+                 repeats=5, measureMemory=True):
+    """Times every operation at every resolution and channel count it works
+    on, and returns a dictionary with the settings and a list of results,
+    ready to be dumped as JSON."""
+    table = dict((name, (worksOn, setup)) for name, worksOn, setup in OPERATIONS)
+    results = []
+    for width, height in resolutions:
+        for channelCount in channels:
+            scene = Scene(width, height, channelCount)
+            try:
+                for name in operations:
+                    worksOn, setup = table[name]
+                    if channelCount not in worksOn:
+                        continue
+
+                    best, mean, poolDraws = timeOperation(setup, scene, repeats)
+                    if measureMemory:
+                        peakBytes = benchmark.peakMemoryOf(lambda run: run(),
+                                                           warmedUp(setup, scene))
+                    else:
+                        peakBytes = None
+
+                    megapixels = width * height / 1e6
+                    results.append({
+                        'operation': name,
+                        'width': width,
+                        'height': height,
+                        'channels': channelCount,
+                        'bestSeconds': best,
+                        'meanSeconds': mean,
+                        'framesPerSecond': 1.0 / best if best else None,
+                        'megapixelsPerSecond': megapixels / best if best else None,
+                        'poolDraws': poolDraws,
+                        'peakMemoryBytes': peakBytes
+                    })
+            finally:
+                scene.cleanup()
+
+    return {
+        'settings': {
+            'operations': list(operations),
+            'resolutions': [list(resolution) for resolution in resolutions],
+            'channels': list(channels),
+            'repeats': repeats,
+            'memoryMethod': benchmark.memoryMethod() if measureMemory else None,
+            'opencvThreads': cv2.getNumThreads()
+        },
+        'results': results
+    }
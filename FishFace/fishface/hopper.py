@@ -3,17 +3,54 @@
 
 
 import imageframe
+import bufferpool
 import os
 import glob
 import time
 
+try:
+    import numpy as np
+except ImportError:
+    print "The hopper module needs numpy."
+    raise
+
 
 class HopperChain:
     """An iterable that constructs a chain of Hopper objects to perform a specific
     set of image processing operations.  Each time HopperChain.next() is called,
-    it returns the next frame from the last hopper in the chain."""
+    it returns the next frame from the last hopper in the chain.
+
+    With recycle=True, the frames share a bufferpool.BufferPool (pool, or a
+    new one), and each frame is released back to the pool when the next frame
+    is asked for (or, with batches(), when the next batch is).  Only use it if
+    you're done with each frame by then; copy anything you want to keep.
+
+    frameArgs is a dictionary of extra arguments for the imageframe.Frame
+    constructor, e.g. {'lazy': True} to put off decoding each image until
+    something needs its pixels.
+
+    With analysisScale (2, 4 or 8), the whole chain works on images decoded
+    at 1/analysisScale size, but the process arguments are still given in
+    full-size pixels: crop boxes, kernels and their radii, line widths and
+    the points and outlines to draw are scaled down to match (see
+    scaleProcess), and calibration frames are decoded again at the same
+    scale (see Frame.rescaled).  absoluteCentroid, fullCroppedTo and
+    fullCentroid come out in full-size coordinates."""
+
+    def __init__(self, firstHopperInput, processList, recycle=False, pool=None,
+                 frameArgs=None, analysisScale=1):
+        self.recycle = recycle
+        self.frameArgs = dict(frameArgs or dict())
+        self.analysisScale = analysisScale
+        if analysisScale != 1:
+            if self.frameArgs.get('decodeScale', analysisScale) != analysisScale:
+                raise HopperChainError("The decodeScale in frameArgs ({}) doesn't match the analysisScale ({}).".format(self.frameArgs['decodeScale'], analysisScale))
+            self.frameArgs['decodeScale'] = analysisScale
+        if recycle and pool is None:
+            pool = bufferpool.BufferPool()
+        self.pool = pool
+        self.handedOut = []
 
-    def __init__(self, firstHopperInput, processList):
         if type(processList) != list:
             raise HopperChainError("I need a list of processes (and their arguments) but I got a(n) {} instead.".format(type(processList)))
         else:
@@ -24,11 +61,15 @@ class HopperChain:
         self.processList = processList
 
         self.chain = [Hopper(firstHopperInput)]
+        self.chain[0].pool = self.pool
+        self.chain[0].frameArgs = self.frameArgs
 
         for process in processList:
             if len(process) != 2:
                 raise HopperChainError("The processList must contain 2-element lists or tuples whose elements are the name of the process and its arguments.")
             else:
+                if self.analysisScale != 1:
+                    process = scaleProcess(process, self.analysisScale)
                 self.chain.append(Hopper(self.chain[-1]))
                 self.chain[-1].setProcess(process)
 
@@ -36,7 +77,120 @@ class HopperChain:
         return self
 
     def next(self):
-        return self.chain[-1].next()
+        self.releaseHandedOut()
+        frame = self.chain[-1].next()
+        self.handOut(frame)
+        return frame
+
+    def handOut(self, frame):
+        if self.recycle:
+            self.handedOut.append(frame)
+
+    def releaseHandedOut(self):
+        """Give the arrays of the frames I've handed out back to the pool."""
+        for frame in self.handedOut:
+            frame.release()
+        self.handedOut = []
+
+    def batches(self, size):
+        """Iterates over lists of up to size frames at a time, for operations
+        that handle many frames at once (e.g. poser.poseBatch)."""
+        batch = []
+        while True:
+            if not batch:
+                self.releaseHandedOut()
+            try:
+                frame = self.chain[-1].next()
+            except StopIteration:
+                break
+            self.handOut(frame)
+            batch.append(frame)
+            if len(batch) == size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+
+# Process arguments that are radii in pixels, and scale with the image.
+SCALED_RADII = ('kernelRadius', 'closeRadius', 'openRadius', 'skelKernelRadius', 'thickener',
+                'circleRadius')
+
+# Other lengths in pixels, which scale the same way.  A negative lineThickness
+# means filled in, and is left alone.
+SCALED_LENGTHS = ('lineThickness', 'length')
+
+# Process arguments that are (x, y) points, or arrays of them.
+SCALED_POINTS = ('points', 'centerPoint', 'aroundPoint')
+
+
+def scaleRadius(radius, scale):
+    """A radius in full-size pixels, in pixels of an image scale times
+    smaller.  Radii don't shrink below 1 (unless they start at 0)."""
+    if radius <= 0:
+        return radius
+    return max(1, int(round(float(radius) / scale)))
+
+
+def scalePoints(points, scale):
+    """A point, or an array of them (e.g. a contour), in pixels of an image
+    scale times smaller."""
+    if isinstance(points, np.ndarray):
+        return (points // scale).astype(points.dtype)
+    return tuple(int(x) // scale for x in points)
+
+
+def scaleKernel(kernel, scale):
+    """A structuring element for an image scale times smaller, with its
+    radius scaled the way scaleRadius does it.  It's sampled outward from the
+    middle, so a symmetric kernel stays symmetric."""
+    def samples(size):
+        radius = size // 2
+        newRadius = scaleRadius(radius, scale)
+        if newRadius == 0:
+            return [radius]
+        steps = np.arange(-newRadius, newRadius + 1) * float(radius) / newRadius
+        return radius + np.round(steps).astype(int)
+
+    return kernel[np.ix_(samples(kernel.shape[0]), samples(kernel.shape[1]))]
+
+
+def scaleProcess(process, scale):
+    """A copy of the (name, args) process for images scale times smaller than
+    the ones its args were written for.  Radii and other lengths, kernels,
+    crop boxes, points and contours are scaled and calibration frames are
+    rescaled; everything else is left alone, including thresholds (which are
+    brightnesses, not sizes) and iteration counts."""
+    name, args = process
+    args = dict(args)
+
+    for key in SCALED_RADII + SCALED_LENGTHS:
+        if key in args:
+            args[key] = scaleRadius(args[key], scale)
+
+    for key in SCALED_POINTS:
+        if key in args:
+            args[key] = scalePoints(args[key], scale)
+
+    if 'contours' in args:
+        args['contours'] = [scalePoints(contour, scale) for contour in args['contours']]
+
+    if 'kernel' in args:
+        args['kernel'] = scaleKernel(args['kernel'], scale)
+
+    # medianFilter's kernelRadius is really the (odd) size of the kernel
+    if name == 'medianFilter' and 'kernelRadius' in args:
+        args['kernelRadius'] = scaleRadius(process[1]['kernelRadius'], scale) | 1
+
+    if 'box' in args:
+        args['box'] = tuple(int(x) // scale for x in args['box'])
+
+    calFrame = args.get('calImageFrame')
+    if calFrame is not None and calFrame.decodeScale != scale:
+        args['calImageFrame'] = calFrame.rescaled(scale)
+
+    return (name, args)
 
 
 class SourceHopperChain(HopperChain):
@@ -63,9 +217,11 @@ class Hopper:
         try:
             processes = {
                 'canny': self.frame.applyCanny,
+                'closeOpen': self.frame.applyCloseOpen,
                 'closing': self.frame.applyClosing,
                 'crop': self.frame.applyCrop,
                 'cropToLargestBlob': self.frame.applyCropToLargestBlob,
+                'cropToLargestComponent': self.frame.applyCropToLargestComponent,
                 'deltaImage': self.frame.applyDeltaImage,
                 'dilate': self.frame.applyDilate,
                 'erode': self.frame.applyErode,
@@ -101,6 +257,8 @@ class Hopper:
 
     def __init__(self, origInput, directory="./"):
         self.debug = False
+        self.pool = None
+        self.frameArgs = dict()
 
         self.origInput = origInput
         if type(origInput) == list:
@@ -149,7 +307,8 @@ class Hopper:
                 self.frame.saveImageToFile(debugFilename)
         else:
             try:
-                self.frame = imageframe.Frame(self.contents[self.cur])
+                self.frame = imageframe.Frame(self.contents[self.cur], pool=self.pool,
+                                              **self.frameArgs)
                 self.processFrame()
             except IndexError:
                 raise StopIteration("End of the list.")
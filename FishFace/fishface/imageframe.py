@@ -6,6 +6,7 @@ The imageframe module provides the imageframe.Frame object (and some supporting
 import os
 import copy
 import math
+import struct
 
 try:
     import numpy as np
@@ -20,6 +21,10 @@ except ImportError:
     print "The imageframe module needs OpenCV."
     raise
 
+import arrayhistory
+import featurecache
+import tiles
+
 
 class Frame:
     """
@@ -33,15 +38,97 @@ It has two main attributes:
         * croppedTo - if we have cropped the image, this is the box that we cropped to
         * shape - current shape of the image (includes number of channels)
         * spatialShape - current shape of the image (just the 2D shape, not the number of channels)
+        * largestContour - after applyCropToLargestBlob, the outline of the blob in the cropped image
+        * moments - after applyCropToLargestBlob, the image moments of the blob (m00 is its area in pixels)
+        * decodeScale - how many times smaller than the file the decoded image is (see below)
+
+If a Frame is given a bufferpool.BufferPool, the operations that make new
+arrays draw them from the pool, and the arrays they replace are given back
+to it.  Only arrays the Frame made itself are given back; an array handed to
+the Frame with copyArray=False is left alone.  Call Frame.release() when
+you're done with the frame to give back its array too.  Don't hang on to
+Frame.array from a pooled Frame after an operation has replaced it.
+
+applyCrop doesn't copy anything: Frame.array becomes a view into the uncropped
+array, marked copy-on-write (Frame.cropView).  Operations that would work in
+place write their results to a new array instead (see writableArray), and
+drawing operations copy the view first (see makeWritable), so the uncropped
+array is never changed through the view.
+
+A Frame made from a filename with lazy=True reads only the file's header (for
+JPEG and PNG files) to fill in the shape information, and doesn't decode the
+image until Frame.array is first used.  Frame.pendingFile is the filename
+until then, and None after.
+
+Image files can be decoded straight to a single channel with gray=True, and
+straight to 1/2, 1/4 or 1/8 scale with decodeScale (JPEG files are scaled by
+the decoder itself, which is much faster than decoding at full size).  The
+scale is kept in Frame.data['decodeScale'], and findCentroid scales the
+absoluteCentroid up by it, so that it's in the coordinates of the full-size file.
+croppedTo and centroid are in the decoded image's coordinates, like the array,
+but fullCroppedTo and fullCentroid are kept alongside them in full-size
+coordinates (see fullScale and fullScalePoint).  Frame.rescaled makes a copy
+at another scale.
+
+Frame.preserveArray keeps a copy of the current array in
+Frame.data['preservedArrays'], an arrayhistory.ArrayHistory.  Only the newest
+historyDepth arrays (and no more than historyBytes) are kept, compressed if
+historyCompression says so (see ArrayHistory).
+
+Frame.features() hands out a featurecache.FeatureCache for the current array,
+so the mask, moments, outlines, etc. are only worked out once however many
+stages (and Posers) ask for them.  A new one is started whenever the array is
+replaced or changed in place, so anything that writes to Frame.array directly
+should call forgetFeatures() afterward.
+
+Given a tiles.TileExecutor, the per-pixel and neighborhood stages (delta,
+threshold, median, dilate, erode and the morphology stages) run on horizontal
+bands of large images in parallel; see Frame.tiled.
+
+Frames pickle compactly, for handing to worker processes or over Pyro: just
+the pixels and the metadata, and the preserved arrays only if
+Frame.pickleHistory is True (see __getstate__).
 """
 
+    # By default, pickled frames keep their preserved arrays; set this to
+    # False (on a frame, or here for all of them) to leave them out.
+    pickleHistory = True
+
 # ##
 # ##  Object Initialization
 # ##
-    def __init__(self, image):
-        self.data = { 'preservedArrays':[] }
+    def __init__(self, image, copyArray=True, pool=None, lazy=False, gray=False, decodeScale=1,
+                 historyDepth=arrayhistory.DEPTH, historyBytes=arrayhistory.MAX_BYTES,
+                 historyCompression=None, executor=None):
+        self.data = { 'preservedArrays':arrayhistory.ArrayHistory(historyDepth, historyBytes,
+                                                                  historyCompression, pool) }
+
+        if (gray, decodeScale) not in IMREAD_FLAGS:
+            raise ImageInitError("I can only decode images at a scale of 1, 2, 4 or 8, not {}.".format(decodeScale))
+
+        self.pool = pool
+        self.executor = executor
+        self.gray = gray
+        self.decodeScale = decodeScale
+        self.array = None
+        self.ownsArray = False
+        self.pendingFile = None
+        self.cropView = False
+        self.viewParent = None
+        self.featureCache = None
+
+        if lazy and type(image) == str:
+            self.setImageFromFile(image, lazy=True)
+        else:
+            self.setImage(image, copyArray)
 
-        self.setImage(image)
+    def __getattr__(self, name):
+        # Only called when name isn't found the normal way, which for array
+        # means a lazy frame that hasn't been decoded yet.
+        if name == 'array' and self.__dict__.get('pendingFile') is not None:
+            self.decode()
+            return self.array
+        raise AttributeError(name)
 
     def setImage(self, image, copyArray=True):
         """The frame is getting a new image.  If it's already a numpy.array with
@@ -53,9 +140,11 @@ It has two main attributes:
         # It's already a numpy array. Store or copy it.
         if(type(image) == np.ndarray):
             if copyArray:
-                self.array = np.copy(image)
+                array = self.newArray(image.shape, image.dtype)
+                np.copyto(array, image)
+                self.replaceArray(array)
             else:
-                self.array = image
+                self.replaceArray(image, owned=False)
 
         # It's a string; treat it like a filename.
         elif(type(image) == str):
@@ -64,34 +153,222 @@ It has two main attributes:
         else:
             raise ImageInitError("setImage requires a numpy array or filename string, but I see a {}".format(type(image)))
 
-        self.data['shape'] = self.array.shape
-
-        if len(self.data['shape']) > 1:
-            self.data['spatialShape'] = tuple(self.data['shape'][:2])
-            self.ydim = self.data['spatialShape'][0]
-            self.xdim = self.data['spatialShape'][1]
-
-            if len(self.data['shape']) == 2:
+    def newArray(self, shape, dtype=np.uint8):
+        """An array for an operation to put its results in.  It comes from my
+        buffer pool if I have one.  The contents are garbage."""
+        if self.pool is None:
+            return np.empty(shape, dtype)
+        return self.pool.take(shape, dtype)
+
+    def giveBack(self, array):
+        """Give an array I'm done with to my buffer pool, if I have one."""
+        if self.pool is not None:
+            self.pool.give(array)
+
+    def replaceArray(self, array, owned=True):
+        """Make array my array, giving the old one back to my buffer pool if it
+        was mine to give.  If owned is False, array belongs to someone else and
+        will never be given to the pool."""
+        if self.ownsArray and self.array is not array:
+            self.giveBack(self.array)
+        self.releaseViewParent()
+        self.forgetFeatures()
+
+        self.array = array
+        self.ownsArray = owned
+        self.pendingFile = None
+        self.updateShape()
+
+    def setView(self, view):
+        """Make view (a view into my array) my array, copy-on-write.  My old
+        array is kept until the view is replaced."""
+        if not self.cropView:
+            # a crop of a crop still belongs to the first array
+            self.viewParent = self.array if self.ownsArray else None
+        self.forgetFeatures()
+
+        self.array = view
+        self.ownsArray = False
+        self.cropView = True
+        self.pendingFile = None
+        self.updateShape()
+
+    def releaseViewParent(self):
+        if self.cropView:
+            self.giveBack(self.viewParent)
+            self.viewParent = None
+            self.cropView = False
+
+    def writableArray(self):
+        """The array an operation that could work in place should write its
+        results to: my array, or a new one if my array is a copy-on-write
+        view.  Pass it to keepResult afterward."""
+        if self.cropView:
+            return self.newArray(self.array.shape, self.array.dtype)
+        return self.array
+
+    def keepResult(self, array):
+        """Make the array from writableArray my array, if it isn't already."""
+        if array is not self.array:
+            self.replaceArray(array)
+        else:
+            self.forgetFeatures()
+
+    def makeWritable(self):
+        """Copy a copy-on-write view into an array of my own, for operations
+        that can only work in place (like drawing)."""
+        if self.cropView:
+            array = self.newArray(self.array.shape, self.array.dtype)
+            np.copyto(array, self.array)
+            self.replaceArray(array)
+        self.forgetFeatures()
+
+    def features(self):
+        """The featurecache.FeatureCache for my array as it is now."""
+        if self.featureCache is None or self.featureCache.array is not self.array:
+            self.featureCache = featurecache.FeatureCache(self.array)
+        return self.featureCache
+
+    def forgetFeatures(self):
+        """My array has changed (or is about to), so start a new feature cache
+        next time."""
+        self.featureCache = None
+
+    def release(self):
+        """I'm done with.  Give my array and any preserved arrays back to my
+        buffer pool."""
+        if self.ownsArray:
+            self.giveBack(self.array)
+        self.releaseViewParent()
+        self.forgetFeatures()
+        self.data['preservedArrays'].clear()
+
+        self.array = None
+        self.ownsArray = False
+        self.pendingFile = None
+
+    def updateShape(self, shape=None):
+        """Bring the shape information up to date with my array, or with the
+        shape it will have once it's decoded."""
+        if shape is None:
+            shape = self.array.shape
+        self.data['shape'] = shape
+
+        if len(shape) > 1:
+            self.data['spatialShape'] = tuple(shape[:2])
+            self.ydim, self.xdim = self.data['spatialShape']
+
+            if len(shape) == 2:
                 self.data['channels'] = 1
-            elif len(self.data['shape']) == 3:
-                self.data['channels'] = self.array.shape[2]
+            elif len(shape) == 3:
+                self.data['channels'] = shape[2]
 
 # ##
 # ##  File I/O
 # ##
-    def setImageFromFile(self, filename):
-        """Get image from file and store as my array."""
+    def setImageFromFile(self, filename, lazy=False):
+        """Get image from file and store as my array.  If lazy, just read the
+        shape from the file's header and leave the decoding until my array is
+        needed.  Files whose headers I can't read are decoded right away."""
+        if lazy and os.path.isfile(filename):
+            header = imageHeader(filename)
+            if header is not None:
+                kind, height, width, channels = header
+
+                # the decoder always hands back one or three channels; the
+                # JPEG decoder rounds the scaled size up, and the rest of them
+                # (PNG) shrink the full image, which rounds it down
+                if kind == 'jpeg':
+                    height = -(-height // self.decodeScale)
+                    width = -(-width // self.decodeScale)
+                else:
+                    height //= self.decodeScale
+                    width //= self.decodeScale
+                if self.gray:
+                    shape = (height, width)
+                else:
+                    shape = (height, width, 3)
+
+                if self.ownsArray:
+                    self.giveBack(self.array)
+                self.__dict__.pop('array', None)
+                self.ownsArray = False
+                self.forgetFeatures()
+                self.pendingFile = filename
+
+                self.data['originalFileName'] = filename
+                self.data['originalFileShape'] = shape
+                self.data['fileChannels'] = channels
+                self.data['decodeScale'] = self.decodeScale
+                self.updateShape(shape)
+                self.ydim, self.xdim = height, width
+                return
+
         if os.path.isfile(filename):
-            self.array = cv2.cvtColor(cv2.imread(filename), cv2.COLOR_RGB2BGR)
+            # a lazy frame has already told everyone what shape it will be
+            if self.pendingFile == filename:
+                expectedShape = self.data['originalFileShape']
+            else:
+                expectedShape = None
+
+            image = cv2.imread(filename, IMREAD_FLAGS[(self.gray, self.decodeScale)])
+            if expectedShape is not None and image.shape != expectedShape:
+                raise ImageInitError("I expected {} to decode to shape {} from its header, but got {}.".format(filename, expectedShape, image.shape))
+            if self.gray:
+                self.replaceArray(image)
+            else:
+                array = self.newArray(image.shape, image.dtype)
+                cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=array)
+                self.replaceArray(array)
             self.data['originalFileName'] = filename
+            self.data['decodeScale'] = self.decodeScale
             self.data['originalFileShape'] = self.array.shape
-            if len(self.array.shape) == 2:
-                self.data['channels'] = 1
-            else:
-                self.data['channels'] = self.array.shape[-1]
         else:
             raise ImageInitError("File not found (or isn't a regular file): {}".format(filename))
 
+    def decode(self):
+        """Decode the image file of a lazy frame, if it hasn't been already."""
+        if self.pendingFile is not None:
+            self.setImageFromFile(self.pendingFile)
+
+    def rescaled(self, decodeScale):
+        """A copy of me at another decodeScale.  If I came from a file, it's
+        decoded again at the new scale and cropped to match me, so anything
+        else done to me since isn't in the copy.  Otherwise my array is
+        resized."""
+        if decodeScale == self.decodeScale:
+            return self.copy()
+
+        scale = float(self.decodeScale) / decodeScale
+
+        if 'originalFileName' in self.data:
+            newFrame = Frame(self.data['originalFileName'], pool=self.pool, gray=self.gray,
+                             decodeScale=decodeScale, executor=self.executor)
+            if 'croppedTo' in self.data:
+                newFrame.applyCrop({'box': tuple(int(x * scale) for x in self.data['croppedTo'])})
+        else:
+            shape = (max(1, int(round(self.xdim * scale))), max(1, int(round(self.ydim * scale))))
+            newFrame = Frame(cv2.resize(self.array, shape, interpolation=cv2.INTER_AREA),
+                             copyArray=False, pool=self.pool, gray=self.gray,
+                             decodeScale=decodeScale, executor=self.executor)
+            newFrame.data['decodeScale'] = decodeScale
+
+        return newFrame
+
+    def fullScale(self, coordinates):
+        """Map coordinates (a point, a box, etc.) in my array back to the
+        full-size image, i.e. multiply them by my decodeScale."""
+        scale = self.data.get('decodeScale', 1)
+        return tuple(x * scale for x in coordinates)
+
+    def fullScalePoint(self, point):
+        """Map a point in my array (which can be between pixels) to the nearest
+        pixel of the full-size image.  Unlike fullScale, this goes by pixel
+        centres: pixel x here covers full-size pixels x*scale to
+        (x+1)*scale-1, so its centre is at (x+0.5)*scale-0.5."""
+        scale = self.data.get('decodeScale', 1)
+        return tuple(int(round((x + 0.5) * scale - 0.5)) for x in point)
+
     def saveImageToFile(self, filename):
         """Save the image to a file."""
         if self.data['channels'] == 1:
@@ -154,7 +431,12 @@ It has two main attributes:
         if 'kernelRadius' not in args:
             args['kernelRadius'] = 1
 
-        cv2.medianBlur(src=self.array, ksize=args['kernelRadius'], dst=self.array)
+        ksize = args['kernelRadius']
+
+        dst = self.writableArray()
+        self.tiled(lambda sources, out: cv2.medianBlur(sources[0], ksize, dst=out),
+                   [self.array], dst, ksize // 2)
+        self.keepResult(dst)
 
     def applyCanny(self, args=dict()):
         """Uses OpenCV's Canny filter implementation to find edges. By default, don't thicken the
@@ -163,11 +445,14 @@ It has two main attributes:
         if 'thickener' not in args:
             args['thickener'] = None
 
-        self.array = cv2.Canny(src=self.array, threshold1=50, threshold2=100, apertureSize=3)
+        edges = self.newArray(self.data['spatialShape'])
+        cv2.Canny(self.array, threshold1=50, threshold2=100, edges=edges, apertureSize=3)
+        self.replaceArray(edges)
 
         if args['thickener']:
             kern = self.kernel(args['thickener'], shape="circle")
             cv2.dilate(src=self.array, kernel=kern, dst=self.array)
+            self.forgetFeatures()
 
     def applyThreshold(self, args=dict()):
         """Wrapper for the cv2 threshold function."""
@@ -175,11 +460,16 @@ It has two main attributes:
         if 'threshold' not in args:
             raise ImageProcessError("I need a threshold to apply.")
 
-        cv2.threshold(src=self.array,
-                      thresh=args['threshold'],
-                      maxval=255,
-                      type=cv2.THRESH_BINARY,
-                      dst=self.array)
+        threshold = args['threshold']
+
+        dst = self.writableArray()
+        self.tiled(lambda sources, out: cv2.threshold(src=sources[0],
+                                                      thresh=threshold,
+                                                      maxval=255,
+                                                      type=cv2.THRESH_BINARY,
+                                                      dst=out)[1],
+                   [self.array], dst)
+        self.keepResult(dst)
 
     def applyDeltaImage(self, args=dict()):
         """Finds the absolute difference between the calImage and my array,
@@ -200,14 +490,18 @@ It has two main attributes:
                 calFrame = calFrame.copy()
                 calFrame.applyGrayImage()
 
-        cv2.absdiff(src1=calFrame.array,
-                    src2=self.array,
-                    dst=self.array)
+        dst = self.writableArray()
+        self.tiled(lambda sources, out: cv2.absdiff(src1=sources[0],
+                                                    src2=sources[1],
+                                                    dst=out),
+                   [calFrame.array, self.array], dst)
+        self.keepResult(dst)
 
     def applyRotate(self, args=dict()):
         """Rotate the image array."""
+        shape = np.array([self.data['spatialShape'][1], self.data['spatialShape'][0]])
+
         if 'aroundPoint' not in args:
-            shape = np.array([self.data['spatialShape'][1], self.data['spatialShape'][0]])
             args['aroundPoint'] = tuple((shape/2.0).astype(np.int32))
 
         if 'scale' not in args:
@@ -224,13 +518,17 @@ It has two main attributes:
 
         rotMatrix = cv2.getRotationMatrix2D(args['aroundPoint'], args['angleDegrees'], args['scale'])
 
-        self.array = cv2.warpAffine(self.array, rotMatrix, tuple(shape), borderMode=args['borderMode'],
-                                    borderValue=args['borderValue'])
+        rotated = self.newArray(self.array.shape, self.array.dtype)
+        cv2.warpAffine(self.array, rotMatrix, tuple(shape), dst=rotated, borderMode=args['borderMode'],
+                       borderValue=args['borderValue'])
+        self.replaceArray(rotated)
 
     def applyGrayImage(self, args=dict()):
         """Convert to grayscale."""
         if self.data['channels'] == 3:
-            self.setImage(cv2.cvtColor(src=self.array, code=cv2.COLOR_RGB2GRAY))
+            gray = self.newArray(self.data['spatialShape'], self.array.dtype)
+            cv2.cvtColor(src=self.array, code=cv2.COLOR_RGB2GRAY, dst=gray)
+            self.replaceArray(gray)
 
     def applyDilate(self, args=dict()):
         """Morphological dilation with provided kernel."""
@@ -244,7 +542,14 @@ It has two main attributes:
         if 'iterations' not in args:
             args['iterations'] = 1
 
-        cv2.dilate(src=self.array, kernel=args['kernel'], dst=self.array, iterations=args['iterations'])
+        kernel = args['kernel']
+        iterations = args['iterations']
+
+        dst = self.writableArray()
+        self.tiled(lambda sources, out: cv2.dilate(src=sources[0], kernel=kernel, dst=out,
+                                                   iterations=iterations),
+                   [self.array], dst, kernelHalo(kernel, iterations))
+        self.keepResult(dst)
 
     def applyErode(self, args=dict()):
         """Morphological erosion with provided kernel."""
@@ -257,7 +562,14 @@ It has two main attributes:
         if 'iterations' not in args:
             args['iterations'] = 1
 
-        cv2.erode(src=self.array, kernel=args['kernel'], dst=self.array, iterations=args['iterations'])
+        kernel = args['kernel']
+        iterations = args['iterations']
+
+        dst = self.writableArray()
+        self.tiled(lambda sources, out: cv2.erode(src=sources[0], kernel=kernel, dst=out,
+                                                  iterations=iterations),
+                   [self.array], dst, kernelHalo(kernel, iterations))
+        self.keepResult(dst)
 
     def applyOpening(self, args=dict()):
         """Morphological opening with generated kernel.  It's essentially an erosion
@@ -273,8 +585,7 @@ It has two main attributes:
 
         args['kernel'] = self.kernel(radius=args['kernelRadius'], shape=args['kernelShape'])
 
-        self.applyErode(args)
-        self.applyDilate(args)
+        self.morphology(cv2.MORPH_OPEN, args['kernel'], args['iterations'])
 
     def applyClosing(self, args=dict()):
         """Morphological closing with generated kernel.  It's essentially a dilation
@@ -290,39 +601,139 @@ It has two main attributes:
 
         args['kernel'] = self.kernel(radius=args['kernelRadius'], shape=args['kernelShape'])
 
-        self.applyDilate(args)
-        self.applyErode(args)
+        self.morphology(cv2.MORPH_CLOSE, args['kernel'], args['iterations'])
+
+    def applyCloseOpen(self, args=dict()):
+        """Morphological closing followed by opening, as one stage.  This is the
+        usual cleanup after thresholding: closing fills the gaps in the fish,
+        then opening throws away the specks around it.  The radii default to
+        kernelRadius (3 if that isn't given either)."""
+        if 'kernelRadius' not in args:
+            args['kernelRadius'] = 3
+
+        if 'closeRadius' not in args:
+            args['closeRadius'] = args['kernelRadius']
+
+        if 'openRadius' not in args:
+            args['openRadius'] = args['kernelRadius']
+
+        if 'kernelShape' not in args:
+            args['kernelShape'] = 'circle'
+
+        if 'iterations' not in args:
+            args['iterations'] = 1
+
+        closeKernel = self.kernel(radius=args['closeRadius'], shape=args['kernelShape'])
+        openKernel = self.kernel(radius=args['openRadius'], shape=args['kernelShape'])
+        iterations = args['iterations']
+
+        def closeOpen(sources, out):
+            out = cv2.morphologyEx(sources[0], cv2.MORPH_CLOSE, closeKernel,
+                                   dst=out, iterations=iterations)
+            return cv2.morphologyEx(out, cv2.MORPH_OPEN, openKernel,
+                                    dst=out, iterations=iterations)
+
+        # closing and opening each look twice as far as their kernels reach
+        halo = 2 * (kernelHalo(closeKernel, iterations) + kernelHalo(openKernel, iterations))
+
+        dst = self.writableArray()
+        self.tiled(closeOpen, [self.array], dst, halo)
+        self.keepResult(dst)
+
+    def morphology(self, operation, kernel, iterations=1):
+        """Apply one of the cv2.morphologyEx operations to my array."""
+        dst = self.writableArray()
+        self.tiled(lambda sources, out: cv2.morphologyEx(sources[0], operation, kernel,
+                                                         dst=out, iterations=iterations),
+                   [self.array], dst, 2 * kernelHalo(kernel, iterations))
+        self.keepResult(dst)
+
+    def tiled(self, operation, sources, dst, halo=0):
+        """Run operation(sources, dst) to fill in dst, on my tiles.TileExecutor
+        in bands if I have one.  halo is how many rows beyond each band the
+        operation needs to see; see TileExecutor.run."""
+        if self.executor is None:
+            operation(sources, dst)
+        else:
+            self.executor.run(operation, sources, dst, halo)
 
     def applySkeletonize(self, args=dict()):
-        """Finds the morphological skeleton."""
+        """Finds the morphological skeleton.  The method arg chooses how:
+            'morphological' - the union of the differences between successive
+                erosions and their openings (the default)
+            'zhangSuen' - Zhang-Suen thinning (see thin), which gives a
+                connected skeleton one pixel wide.  It only works on the
+                silhouette's bounding box, so on a big image that hasn't
+                been cropped it's much faster (about 9ms against 125ms for
+                a 2048x1536 image), but on an image already cropped to the
+                fish the morphological method is two or three times
+                faster.
+            'auto' - whichever of those is faster for this image: Zhang-Suen
+                if the image is more than SKELETON_AUTO_RATIO times the area
+                of the silhouette's bounding box, and the morphological
+                method otherwise (as on a cropped image).  Be aware that the
+                two don't give the same skeleton."""
 
         if self.data['channels'] > 1:
             raise ImageProcessError("I can only find the morphological skeleton of single-channel images, but I see {} channels.".format(self.data['channels']))
 
+        if 'method' not in args:
+            args['method'] = 'morphological'
+
+        method = args['method']
+        if method == 'auto':
+            x, y, width, height = cv2.boundingRect(self.array)
+            if np.size(self.array) > SKELETON_AUTO_RATIO * width * height:
+                method = 'zhangSuen'
+            else:
+                method = 'morphological'
+
+        if method == 'zhangSuen':
+            dst = self.writableArray()
+            thin(self.array, out=dst)
+            self.keepResult(dst)
+            return
+
+        if method != 'morphological':
+            raise ImageProcessError("I don't know the skeletonization method {}.".format(method))
+
         if 'skelKernelRadius' not in args:
             args['skelKernelRadius'] = 1
 
         if 'skelKernelShape' not in args:
-            args['skelKernelShape'] = 1
+            args['skelKernelShape'] = 'cross'
 
-        src = np.copy(self.array)
+        # scratch arrays for the loop; src and eroded trade places each pass
+        src = self.newArray(self.array.shape, self.array.dtype)
+        np.copyto(src, self.array)
+        eroded = self.newArray(self.array.shape, self.array.dtype)
+        temp = self.newArray(self.array.shape, self.array.dtype)
         size = np.size(src)
 
+        # the skeleton is built up from nothing
+        skeleton = self.writableArray()
+        skeleton[...] = 0
+
         kern = self.kernel(radius=args['skelKernelRadius'], shape=args['skelKernelShape'])
 
         complete = False
 
         while(not complete):
-            eroded = cv2.erode(src, kern)
-            temp = cv2.dilate(eroded, kern)
-            temp = cv2.subtract(src, temp)
-            self.array = cv2.bitwise_or(self.array, temp)
-            src = np.copy(eroded)
+            cv2.erode(src, kern, dst=eroded)
+            cv2.dilate(eroded, kern, dst=temp)
+            cv2.subtract(src, temp, dst=temp)
+            cv2.bitwise_or(skeleton, temp, dst=skeleton)
+            src, eroded = eroded, src
 
             zeros = size - cv2.countNonZero(src)
             if zeros == size:
                 complete = True
 
+        self.keepResult(skeleton)
+
+        for array in (src, eroded, temp):
+            self.giveBack(array)
+
     def applyCrop(self, args=dict()):
         """Crops the image to the box provided."""
 
@@ -340,6 +751,7 @@ It has two main attributes:
             self.data['croppedTo'] = [a + b for a, b in zip(box, addme)]
         else:
             self.data['croppedTo'] = box
+        self.data['fullCroppedTo'] = self.fullScale(self.data['croppedTo'])
 
         if 'centroid' in self.data:
             sct = self.data['croppedTo']
@@ -347,22 +759,84 @@ It has two main attributes:
             self.data['centroid'] = (self.data['centroid'][0] + addme[0],
                                      self.data['centroid'][1] + addme[1])
 
-        self.setImage(self.array[box[0]:box[2], box[1]:box[3]])
+        self.setView(self.array[box[0]:box[2], box[1]:box[3]])
 
     def applyCropToLargestBlob(self, args=dict()):
-        contours = self.findAllContours()
-        areas = [cv2.contourArea(ctr) for ctr in contours]
-        if len(areas):
-            max_contour = [contours[areas.index(max(areas))]]
+        self.findAllContours()
+        largest = self.features().largestContour()
+        if largest is not None:
+            max_contour = [largest]
             self.drawContours({'contours': max_contour})
 
             boundingBox = self.boundingBoxFromContour(max_contour)
             self.applyCrop({'box': boundingBox})
 
-            self.data['moments'] = cv2.moments(self.array)
+            # keep the outline, moved to match the cropped image
+            self.data['largestContour'] = max_contour[0] - np.array([boundingBox[1], boundingBox[0]],
+                                                                    dtype=max_contour[0].dtype)
+
+            features = self.features()
+            features.store('largestContour', self.data['largestContour'])
+            self.data['moments'] = features.moments()
         else:
             print "No contours found in this frame."
 
+    def applyCropToLargestComponent(self, args=dict()):
+        """Like applyCropToLargestBlob, but finds the largest blob by labelling
+        the connected components of the image (with 8-connectivity), which
+        gets the area and bounding box of every blob in one pass.  Only the
+        part of the image with anything in it is labelled.  The blob's holes
+        are filled in by filling in its outline, as applyCropToLargestBlob
+        does, and croppedTo, largestContour and moments are filled in the same
+        way, so findCentroid works the same afterward.  The one difference is
+        that the crop keeps only the largest blob; any other blobs that fall
+        inside its bounding box are left out (applyCropToLargestBlob leaves
+        them in, and counts them in the moments)."""
+
+        if self.data['channels'] > 1:
+            raise ImageProcessError("I can only find components in single-channel images, but I see {} channels.".format(self.data['channels']))
+
+        # the labelling is done inside the bounding box of everything, with
+        # room for the border boundingBoxFromRect puts around the crop
+        top, left, bottom, right = self.boundingBoxFromRect(self.features().boundingRect())
+        region = self.array[top:bottom, left:right]
+
+        if hasattr(cv2, 'connectedComponentsWithStatsWithAlgorithm'):
+            count, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(
+                region, 8, cv2.CV_32S, cv2.CCL_GRANA)
+        else:
+            count, labels, stats, _ = cv2.connectedComponentsWithStats(region, connectivity=8)
+
+        # label 0 is the background
+        if count < 2:
+            print "No components found in this frame."
+            return
+
+        label = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+        rect = [int(value) for value in
+                stats[label, [cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT]]]
+        rect[0] += left
+        rect[1] += top
+
+        boundingBox = self.boundingBoxFromRect(rect)
+        self.applyCrop({'box': boundingBox})
+
+        # replace the cropped view with just the largest component
+        mask = self.newArray(self.data['spatialShape'])
+        cv2.compare(labels[boundingBox[0] - top:boundingBox[2] - top,
+                           boundingBox[1] - left:boundingBox[3] - left],
+                    label, cv2.CMP_EQ, dst=mask)
+
+        # one blob has one outline
+        outline = featurecache.FeatureCache(mask).largestContour()
+        cv2.drawContours(mask, [outline], -1, 255, -1)
+        self.replaceArray(mask)
+
+        self.data['largestContour'] = outline
+        features = self.features()
+        features.store('largestContour', outline)
+        self.data['moments'] = features.moments()
+
     def applyResize(self, args=dict()):
         """Resizes the image to the new shape provided."""
 
@@ -374,11 +848,11 @@ It has two main attributes:
         # save the last shape and the new shape for future reference
         self.data['last_shape'] = self.data['shape']
         self.data['new_shape'] = shp
-        self.data['spatialShape'] = tuple(shp)
-        self.ydim = self.data['spatialShape'][0]
-        self.xdim = self.data['spatialShape'][1]
 
-        self.setImage(cv2.resize(self.array, shp))
+        # cv2.resize takes the new shape as (width, height)
+        resized = self.newArray((shp[1], shp[0]) + self.array.shape[2:], self.array.dtype)
+        cv2.resize(self.array, tuple(shp), dst=resized)
+        self.replaceArray(resized)
 
 
 # ##
@@ -412,6 +886,8 @@ It has two main attributes:
         if self.data['channels'] == 1:
             args['lineColor'] = int(sum(args['lineColor']) / 3)
 
+        self.makeWritable()
+
         for point in args['points']:
             cv2.circle(img=self.array,
                        center=tuple(point),
@@ -434,6 +910,8 @@ It has two main attributes:
         if args['filledIn']:
             args['lineThickness'] = -abs(args['lineThickness'])
 
+        self.makeWritable()
+
         cv2.drawContours(image=self.array,
                          contours=args['contours'],
                          contourIdx= -1,
@@ -483,7 +961,8 @@ It has two main attributes:
 # ##
 
     def preserveArray(self, args=None):
-        self.data['preservedArrays'].append(np.copy(self.array))
+        """Keep a copy of my array in my history (data['preservedArrays'])."""
+        self.data['preservedArrays'].append(self.array)
 
     def findAllContours(self):
         """Returns a list of all contours in the single-channel image."""
@@ -493,10 +972,7 @@ It has two main attributes:
 
         # I don't care about the hierarchy; I just want the contours.
 
-        self.data['allContours'] =  cv2.findContours(self.array,
-                                    mode=cv2.RETR_EXTERNAL,
-                                    method=cv2.CHAIN_APPROX_SIMPLE
-                                    )[1]
+        self.data['allContours'] = self.features().contours()
 
         return self.data['allContours']
 
@@ -505,7 +981,13 @@ It has two main attributes:
         of the form (y_min, x_min, y_max, x_max).  The border is an optional extra
         margin to include in the cropped image."""
 
-        xCorner, yCorner, width, height = cv2.boundingRect(contour[0])
+        return self.boundingBoxFromRect(cv2.boundingRect(contour[0]), border)
+
+    def boundingBoxFromRect(self, rect, border=1):
+        """The bounding box, in the same form as boundingBoxFromContour, of an
+        OpenCV rectangle (x, y, width, height)."""
+
+        xCorner, yCorner, width, height = rect
 
         xMin = max(0, xCorner - border)
         yMin = max(0, yCorner - border)
@@ -516,17 +998,10 @@ It has two main attributes:
 
     def kernel(self, radius=3, shape="circle"):
         """Convenience method wrapping the cv2.getStructuringElement method.
-        Radius and shape can be specified."""
-
-        if shape == "circle":
-            shp = cv2.MORPH_ELLIPSE
-        elif shape == "cross":
-            shp = cv2.MORPH_CROSS
-        elif shape == "rectangle":
-            shp = cv2.MORPH_RECT
-        else:
-            raise ImageProcessError("Couldn't create a kernel with shape: {}".format(shape))
-        return cv2.getStructuringElement(shp, (radius * 2 + 1, radius * 2 + 1))
+        Radius and shape can be specified.  Kernels are made once and shared
+        (see structuringElement), so the one you get is read-only; copy it
+        to change it."""
+        return structuringElement(radius, shape)
 
     def findCentroid(self, args=dict()):
         if 'moments' not in self.data:
@@ -536,14 +1011,17 @@ It has two main attributes:
         m10 = self.data['moments']['m10']
         m01 = self.data['moments']['m01']
 
-        x = int(m10/m00)
-        y = int(m01/m00)
+        # keep the centroid between pixels until it's been scaled up, so the
+        # full-size one isn't off by up to a whole decodeScale
+        x = m10/m00
+        y = m01/m00
 
-        self.data['centroid'] = (x,y)
+        self.data['centroid'] = (int(x),int(y))
+        self.data['fullCentroid'] = self.fullScalePoint((x,y))
         if 'croppedTo' in self.data:
             sct = self.data['croppedTo']
             addme = (sct[1],sct[0])
-            self.data['absoluteCentroid'] = (x+addme[0], y+addme[1])
+            self.data['absoluteCentroid'] = self.fullScalePoint((x+addme[0], y+addme[1]))
 
         return self.data['centroid']
 
@@ -561,18 +1039,291 @@ It has two main attributes:
     def __copy__(self):
         """The actual implementation of the object shallowcopy() method.  Named so that
         the copy module can find it."""
-        newFrame = Frame(self.array, copyArray=False)
+        if self.pendingFile is not None:
+            newFrame = Frame(self.pendingFile, pool=self.pool, lazy=True,
+                             gray=self.gray, decodeScale=self.decodeScale,
+                             executor=self.executor)
+        else:
+            newFrame = Frame(self.array, copyArray=False, pool=self.pool,
+                             gray=self.gray, decodeScale=self.decodeScale,
+                             executor=self.executor)
+            # a copy of a view mustn't write through it either
+            newFrame.cropView = self.cropView
         newFrame.data = copy.copy(self.data)
         return newFrame
 
     def __deepcopy__(self, memodic=None):
         """The actual implementation of the object copy() method.  Named so that
         the copy module can find it."""
-        newFrame = Frame(np.zeros(self.data['shape']))
-        newFrame.array = np.copy(self.array)
+        if self.pendingFile is not None:
+            newFrame = Frame(self.pendingFile, pool=self.pool, lazy=True,
+                             gray=self.gray, decodeScale=self.decodeScale,
+                             executor=self.executor)
+        else:
+            newFrame = Frame(self.array, pool=self.pool,
+                             gray=self.gray, decodeScale=self.decodeScale,
+                             executor=self.executor)
         newFrame.data = copy.deepcopy(self.data)
         return newFrame
 
+# ##
+# ##  Pickling
+# ##
+    def __getstate__(self):
+        """Pickle just what it takes to rebuild me elsewhere: my pixels, as one
+        contiguous array, and my metadata.  My buffer pool, executor and
+        feature cache stay behind, as do the contours in data['allContours']
+        (findAllContours finds them again), and my history too if
+        pickleHistory is False.  A lazy frame sends its filename instead of
+        its pixels.
+
+        numpy hands contiguous arrays to pickle protocol 5 as out-of-band
+        buffers, so with protocol 5 and a buffer_callback the pixels aren't
+        copied into the pickle at all."""
+        data = copy.copy(self.data)
+        for key in PICKLE_DROPPED:
+            data.pop(key, None)
+
+        if not self.pickleHistory:
+            history = data['preservedArrays']
+            data['preservedArrays'] = arrayhistory.ArrayHistory(history.depth, history.maxBytes,
+                                                                history.compression)
+
+        if self.pendingFile is not None:
+            array = None
+        else:
+            array = np.ascontiguousarray(self.array)
+
+        return {
+            'array': array,
+            'pendingFile': self.pendingFile,
+            'gray': self.gray,
+            'decodeScale': self.decodeScale,
+            'data': data
+        }
+
+    def __setstate__(self, state):
+        if state['pendingFile'] is not None:
+            self.__init__(state['pendingFile'], lazy=True, gray=state['gray'],
+                          decodeScale=state['decodeScale'])
+        else:
+            self.__init__(state['array'], copyArray=False, gray=state['gray'],
+                          decodeScale=state['decodeScale'])
+        self.data = state['data']
+
+
+def kernelHalo(kernel, iterations=1):
+    """How many rows away from a pixel a dilation or erosion with kernel (and
+    its default anchor in the middle) looks, over all the iterations."""
+    return (kernel.shape[0] // 2) * iterations
+
+
+# data entries that aren't worth pickling
+PICKLE_DROPPED = ('allContours',)
+
+
+# Structuring elements, by (radius, shape), for structuringElement
+KERNELS = dict()
+
+KERNEL_SHAPES = {
+    'circle': cv2.MORPH_ELLIPSE,
+    'cross': cv2.MORPH_CROSS,
+    'rectangle': cv2.MORPH_RECT
+}
+
+
+def structuringElement(radius=3, shape="circle"):
+    """The cv2.getStructuringElement kernel with the given radius and shape
+    ("circle", "cross" or "rectangle").  Each one is made once and kept in
+    KERNELS, so every frame shares it, and it's made read-only so that one
+    frame can't change it under the others."""
+    key = (radius, shape)
+    if key not in KERNELS:
+        if shape not in KERNEL_SHAPES:
+            raise ImageProcessError("Couldn't create a kernel with shape: {}".format(shape))
+        kernel = cv2.getStructuringElement(KERNEL_SHAPES[shape], (radius * 2 + 1, radius * 2 + 1))
+        kernel.flags.writeable = False
+        KERNELS[key] = kernel
+
+    return KERNELS[key]
+
+
+# applySkeletonize's 'auto' method uses Zhang-Suen thinning when the image is
+# more than this many times the area of the silhouette's bounding box.  Around
+# here the two methods take about as long.
+SKELETON_AUTO_RATIO = 4
+
+# The neighbors of a pixel, as (row, column) offsets, clockwise from the one
+# above.  Neighbor i is bit i of a pixel's neighborhood code.
+NEIGHBORS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+
+
+def _zhangSuenTables():
+    """Which of the 256 neighborhood codes mark a pixel for deletion in the
+    first and second halves of a Zhang-Suen pass."""
+    first = np.zeros(256, dtype=bool)
+    second = np.zeros(256, dtype=bool)
+
+    for code in range(256):
+        p2, p3, p4, p5, p6, p7, p8, p9 = [(code >> bit) & 1 for bit in range(8)]
+        ring = (p2, p3, p4, p5, p6, p7, p8, p9)
+
+        # how many neighbors are set, and how many times the ring of
+        # neighbors goes from unset to set
+        count = sum(ring)
+        transitions = sum(1 for i in range(8) if not ring[i] and ring[(i + 1) % 8])
+
+        if 2 <= count <= 6 and transitions == 1:
+            first[code] = not (p2 and p4 and p6) and not (p4 and p6 and p8)
+            second[code] = not (p2 and p4 and p8) and not (p2 and p6 and p8)
+
+    return first, second
+
+ZHANG_SUEN_TABLES = _zhangSuenTables()
+
+# A filter2D kernel that turns a 0/1 image into neighborhood codes: each
+# neighbor in NEIGHBORS is weighted by its bit.
+NEIGHBOR_WEIGHTS = np.float32([[128, 1, 2],
+                               [64, 0, 4],
+                               [32, 16, 8]])
+
+
+
+def thin(array, out=None):
+    """Zhang-Suen thinning of a binary (zero/nonzero) array down to a skeleton
+    one pixel wide.  Returns the skeleton as a 0/255 uint8 array (in out, if
+    it's given).
+
+    Only the silhouette's bounding box (plus a border of zeros, so every
+    pixel has eight neighbors) is worked on.  Pixels deep inside the
+    silhouette can't be deleted, so only the ones at its edge are looked at to
+    begin with, and after that only the ones left over and the neighbors of
+    the ones just deleted.  Each half of a pass packs the neighbors of those
+    pixels into neighborhood codes (see NEIGHBORS) and looks up which should
+    be deleted in ZHANG_SUEN_TABLES, all at once.  It takes about as many
+    passes as the silhouette is thick."""
+    if out is None:
+        out = np.empty(array.shape, dtype=np.uint8)
+
+    x, y, width, height = cv2.boundingRect(array)
+    skeleton = np.zeros((height + 2, width + 2), dtype=np.uint8)
+    np.not_equal(array[y:y + height, x:x + width], 0, out=skeleton[1:-1, 1:-1])
+
+    # out may be array itself, so it's only cleared once the silhouette is
+    # copied out
+    out[...] = 0
+    if not width:
+        return out
+
+    codes = cv2.filter2D(skeleton, cv2.CV_8U, NEIGHBOR_WEIGHTS, borderType=cv2.BORDER_CONSTANT)
+
+    # work with positions in the flattened array, so a neighbor is an
+    # offset; packbits puts the first column in the top bit, so the offsets go
+    # from bit 7 down to bit 0
+    flat = skeleton.ravel()
+    offsets = np.array([dy * (width + 2) + dx for dy, dx in reversed(NEIGHBORS)])
+
+    # start with the pixels that have at least one unset neighbor
+    candidates = np.flatnonzero((flat != 0) & (codes.ravel() != 255))
+    marked = np.zeros(flat.shape, dtype=bool)
+
+    # stop after a whole pass (both halves) without any deletions
+    quiet = 0
+    half = 0
+    while quiet < 2 and len(candidates):
+        neighbors = candidates[:, np.newaxis] + offsets
+        codes = np.packbits(flat[neighbors], axis=1).ravel()
+        delete = ZHANG_SUEN_TABLES[half][codes]
+        half = 1 - half
+
+        if not delete.any():
+            quiet += 1
+            continue
+        quiet = 0
+
+        flat[candidates[delete]] = 0
+
+        # the neighbors of deleted pixels might be deletable now
+        marked[neighbors[delete].ravel()] = True
+        marked[candidates] = True
+        candidates = np.flatnonzero(marked & (flat != 0))
+        marked[...] = False
+
+    np.multiply(skeleton[1:-1, 1:-1], 255, out=out[y:y + height, x:x + width])
+    return out
+
+
+# imread flags for each (gray, decodeScale)
+IMREAD_FLAGS = {
+    (False, 1): cv2.IMREAD_COLOR,
+    (False, 2): cv2.IMREAD_REDUCED_COLOR_2,
+    (False, 4): cv2.IMREAD_REDUCED_COLOR_4,
+    (False, 8): cv2.IMREAD_REDUCED_COLOR_8,
+    (True, 1): cv2.IMREAD_GRAYSCALE,
+    (True, 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (True, 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (True, 8): cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+
+# JPEG start-of-frame markers, which hold the image dimensions.  The rest of
+# C0-CF are other things (DHT, JPG, DAC).
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+# PNG color types and their number of channels
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+
+def imageHeader(filename):
+    """Reads (kind, height, width, channels) from the header of a JPEG or PNG
+    file without decoding it, where kind is 'jpeg' or 'png'.  Returns None for
+    other kinds of files, or if the header doesn't make sense."""
+    with open(filename, 'rb') as f:
+        start = f.read(8)
+
+        if start == '\x89PNG\r\n\x1a\n':
+            ihdr = f.read(18)
+            if len(ihdr) < 18 or ihdr[4:8] != 'IHDR':
+                return None
+            width, height, _, colorType = struct.unpack('>IIBB', ihdr[8:18])
+            if colorType not in PNG_CHANNELS:
+                return None
+            return 'png', height, width, PNG_CHANNELS[colorType]
+
+        if start[:2] != '\xff\xd8':
+            return None
+
+        # walk the JPEG segments until the start of frame
+        f.seek(2)
+        while True:
+            byte = f.read(1)
+            if byte != '\xff':
+                return None
+
+            marker = f.read(1)
+            while marker == '\xff':
+                marker = f.read(1)
+            if not marker:
+                return None
+            marker = ord(marker)
+
+            # markers without a length
+            if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                continue
+
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            length = struct.unpack('>H', length)[0]
+
+            if marker in JPEG_SOF_MARKERS:
+                sof = f.read(6)
+                if len(sof) < 6:
+                    return None
+                _, height, width, channels = struct.unpack('>BHHB', sof)
+                return 'jpeg', height, width, channels
+
+            f.seek(length - 2, 1)
+
 
 # Definitions of custom exceptions
 
@@ -6,6 +6,7 @@ import math
 import hopper
 import imageframe
 import poser
+import featurecache
 
 try:
     import numpy as np
@@ -39,9 +40,7 @@ class Poseidon:
         for fr in HC:
 
             if fr.xdim + fr.ydim < 600:
-                frgray = fr.copy()
-                frgray.applyGrayImage()
-                po = poser.Poser(frgray.array)
+                po = poser.Poser(fr.features())
 
                 axisAngle = po.findLongAxis()
 
@@ -56,10 +55,17 @@ class Poseidon:
                 print "skipped {}".format(fr.data['originalFileName'])
 
     def extremaAnalysis(self, array, alsoReturnMinima=False):
-                array = np.copy(array)
-                array[array > 0] = 1
+                """Finds the local maxima (and minima) of the number of
+                silhouette pixels in each column.  array can be a
+                featurecache.FeatureCache (e.g. Frame.features()) instead, to
+                use the column counts it already has."""
+                if isinstance(array, featurecache.FeatureCache):
+                    perpSum = array.columnCounts()
+                else:
+                    array = np.copy(array)
+                    array[array > 0] = 1
 
-                perpSum = np.int32(np.sum(array, axis=0))
+                    perpSum = np.int32(np.sum(array, axis=0))
                 deltas = np.diff(perpSum)
 
                 minima = []
@@ -122,8 +128,7 @@ class Poseidon:
             ('deltaImage', {'calImageFrame': self.calImage}),
             ('grayImage', {}),
             ('threshold', {'threshold': 60}),
-            ('closing', {'kernelRadius': 3}),
-            ('opening', {'kernelRadius': 3}),
+            ('closeOpen', {'kernelRadius': 3}),
             ('cropToLargestBlob', {})
         ]
 
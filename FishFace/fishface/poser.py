@@ -17,8 +17,75 @@ except ImportError:
     print "The imageframe module needs OpenCV."
     raise
 
+import arraycache
+import featurecache
+
+# Default memory budgets for the caches each Poser keeps.
+ROTATION_CACHE_BYTES = 32 * 2 ** 20
+HORSUM_CACHE_BYTES = 2 * 2 ** 20
+
+# Roughly how many silhouette pixels poseBatch handles in one go.
+BATCH_CHUNK_PIXELS = 2 ** 14
+
+# Pyramid levels smaller than this many pixels on a side are skipped, and the
+# narrow searches at the finer levels look this many degrees either way.
+PYRAMID_MIN_SIZE = 12
+PYRAMID_WINDOW = 6
+
+# The 'warp' engine pads each silhouette up to a multiple of this many pixels
+# on a side, so that silhouettes of similar size can share rotation maps.  The
+# maps are shared by every Poser, within a memory budget.
+WARP_BUCKET = 16
+WARP_MAP_CACHE_BYTES = 64 * 2 ** 20
+warpMaps = arraycache.ArrayCache(WARP_MAP_CACHE_BYTES)
+
+# How many angles the 'polar' engine resamples the silhouette into.
+POLAR_BINS = 360
 
 class Poser:
+    """Finds the orientation of a single binary silhouette.
+
+The engine that does the heavy lifting in findLongAxis can be chosen when the
+Poser is created:
+    'rotate' - rotate the whole silhouette for each candidate angle and sum
+        the rows of the result (the original method)
+    'warp' - like 'rotate', but the rotations are nearest-neighbor lookups
+        through precomputed OpenCV rotation maps, which are shared by all
+        silhouettes of about the same size; see warpMap
+    'projection' - project the foreground pixel coordinates onto each
+        candidate angle and histogram them; no rotations needed
+    'moment' - closed-form axis from the second-order image moments; see
+        momentPose
+    'calipers' - the longest extent of the outline's convex hull, found with
+        rotating calipers; see calipersPose.  Give it the outline with the
+        contour argument if you already have it (e.g. the 'largestContour'
+        that Frame.applyCropToLargestBlob keeps).
+    'polar' - resample the silhouette into polar coordinates around its
+        centroid once, and find the pose by circular correlation of its
+        angular profile; see polarPose.  Give it a reference profile with the
+        template argument (see polarTemplate) to correlate against that
+        instead of the silhouette's own mirror image.
+
+Rotations and horizontal sums are kept in memory-bounded caches (see the
+arraycache module); Poser.rots.stats() shows how well they're doing.
+
+For the 'rotate', 'warp' and 'projection' engines, pyramid can be given as a sequence of
+decimation factors, e.g. (8,) or (8, 2).  The full sweep is then done on a
+copy of the silhouette shrunk by the largest factor, using coarseIterations
+passes, and only narrow searches are done at each finer level and at full
+resolution.  If any level can't find a trustworthy answer, the normal sweep
+at full resolution is done instead.
+
+After findLongAxis, Poser.confidence holds the engine's confidence in the
+answer (from 0 to 1), if the engine provides one.
+
+Instead of an array, a Poser can be given a featurecache.FeatureCache (e.g.
+Frame.features()).  It then uses the cache's mask as its silhouette, without
+copying it, and takes the moments and outline from the cache, so nothing the
+Frame has already worked out is worked out again.
+"""
+
+    ENGINES = ('rotate', 'warp', 'projection', 'moment', 'calipers', 'polar')
 
     def momentLongAxis(self):
         mu00 = self.moms['m00']
@@ -27,24 +94,284 @@ class Poser:
         mu11p = self.moms['mu11'] / mu00
         if mu11p == 0:
             return False
+        elif mu20p == mu02p:
+            # the axis is on a diagonal; this is the limit of the formula below
+            return math.copysign(45.0, mu11p)
         else:
             return math.degrees(0.5 * math.atan((2*mu11p)/(mu20p - mu02p)))
 
-    def fastFindLongAxis(self):
+    def momentPose(self, headMethod='moments'):
+        """Finds the pose straight from the image moments, without rotating or
+        searching.  The axis comes from the second-order moments.  The head end
+        is chosen either from the third-order moments ('moments'), on the
+        grounds that the thin tail skews the mass distribution toward itself,
+        or from a signed count of the pixels on either side of the middle
+        ('projection'), which matches the decision findLongAxis makes.
 
-        offset = int(self.momentLongAxis())
+        Returns (angle, confidence).  The angle follows the findLongAxis
+        convention.  The confidence is the product of the elongation of the
+        silhouette and the strength of the head/tail decision, so it's near
+        zero for round blobs and for blobs that look the same at both ends."""
 
-        for candidate in range(0,360,90):
-            candidate = (candidate - offset) % 360
+        m00 = self.moms['m00']
+        if m00 == 0:
+            raise ArrayProcessError("I can't find the pose of an empty silhouette.")
 
-            self.rotate(candidate)
-            self.horsum(candidate)
+        mu20 = self.moms['mu20']
+        mu02 = self.moms['mu02']
+        mu11 = self.moms['mu11']
+
+        # direction of the long axis in image coordinates (y pointing down)
+        theta = 0.5 * math.atan2(2 * mu11, mu20 - mu02)
+        c = math.cos(theta)
+        s = math.sin(theta)
+
+        # eigenvalues of the second-moment matrix
+        spread = math.hypot((mu20 - mu02) / 2.0, mu11)
+        major = (mu20 + mu02) / 2.0 + spread
+        minor = (mu20 + mu02) / 2.0 - spread
+        if major <= 0:
+            raise ArrayProcessError("I can't find the long axis of a single point.")
+
+        axisConfidence = (major - minor) / (major + minor)
+
+        if headMethod == 'moments':
+            # third central moment of the mass along the long axis
+            m3 = (self.moms['mu30'] * c ** 3 +
+                  3 * self.moms['mu21'] * c ** 2 * s +
+                  3 * self.moms['mu12'] * c * s ** 2 +
+                  self.moms['mu03'] * s ** 3)
+            skewness = (m3 / m00) / (major / m00) ** 1.5
+            if skewness > 0:
+                c, s = -c, -s
+            headConfidence = min(1.0, abs(skewness))
+
+        elif headMethod == 'projection':
+            ys, xs = self.foregroundCoords()
+            along = c * xs + s * ys
+            balance = np.count_nonzero(along > 0) - np.count_nonzero(along < 0)
+            if balance < 0:
+                c, s = -c, -s
+            headConfidence = abs(balance) / float(len(along))
+
+        else:
+            raise ArrayProcessError("I don't know the head/tail method {}.".format(headMethod))
+
+        # flip y so that angles run counterclockwise, then land in [-180,180)
+        angle = (math.degrees(math.atan2(-s, c)) + 180) % 360 - 180
+
+        return angle, axisConfidence * headConfidence
+
+    def largestContour(self):
+        """The outline of the largest blob in the array, as an OpenCV contour.
+        It's found once and stored, unless it was handed to the constructor."""
+        if self.contour is None and self.features is not None:
+            self.contour = self.features.largestContour()
+            if self.contour is None:
+                raise ArrayProcessError("I can't find an outline in an empty silhouette.")
+
+        if self.contour is None:
+            # findContours returns two or three things depending on the
+            # version of OpenCV; the contours are always second from the end
+            contours = cv2.findContours(np.copy(self.array),
+                                        mode=cv2.RETR_EXTERNAL,
+                                        method=cv2.CHAIN_APPROX_SIMPLE)[-2]
+            if not len(contours):
+                raise ArrayProcessError("I can't find an outline in an empty silhouette.")
+            self.contour = max(contours, key=cv2.contourArea)
+
+        return self.contour
+
+    def calipersPose(self):
+        """Finds the pose from the outline instead of the pixels.  Rotating
+        calipers around the convex hull of the outline find the longest extent
+        of the silhouette (its diameter) and the narrowest.  The outline is
+        then cut in two across the middle of the diameter, and the end with
+        the larger area is the head.  The work depends on the number of points
+        in the outline, not the number of pixels.
+
+        Returns (angle, length, confidence).  The angle follows the
+        findLongAxis convention, the length is the length of the long axis in
+        pixels, and the confidence is worked out like sweepConfidence's, with
+        the narrowest extent standing in for the shortest row and the two
+        areas for the left and right sums."""
+
+        outline = np.float64(self.largestContour()).reshape(-1, 2)
+        hull = np.float64(cv2.convexHull(np.float32(outline))).reshape(-1, 2)
+        count = len(hull)
+
+        if count == 1:
+            return 0.0, 0.0, 0.0
+
+        def spread(edge, point):
+            # twice the area of the triangle from edge[0] to edge[1] to point
+            return abs((edge[1][0] - edge[0][0]) * (point[1] - edge[0][1]) -
+                       (edge[1][1] - edge[0][1]) * (point[0] - edge[0][0]))
+
+        far = (0, 0)
+        longest = 0.0
+        narrowest = None
+
+        # Walk an edge of the hull all the way round, keeping the other jaw of
+        # the calipers on the point farthest from that edge.  The farthest
+        # pair of points is always one of the pairs the jaws touch.
+        j = 1
+        for i in range(count):
+            edge = (hull[i], hull[(i + 1) % count])
+            while spread(edge, hull[(j + 1) % count]) > spread(edge, hull[j]):
+                j = (j + 1) % count
+
+            edgeLength = math.hypot(edge[1][0] - edge[0][0], edge[1][1] - edge[0][1])
+            if edgeLength > 0 and count > 2:
+                width = spread(edge, hull[j]) / edgeLength
+                if narrowest is None or width < narrowest:
+                    narrowest = width
+
+            for k in (i, (i + 1) % count):
+                length = math.hypot(hull[j][0] - hull[k][0], hull[j][1] - hull[k][1])
+                if length > longest:
+                    longest = length
+                    far = (k, j)
+
+        if narrowest is None:
+            narrowest = 0.0
+
+        # direction of the long axis in image coordinates (y pointing down)
+        start, end = hull[far[0]], hull[far[1]]
+        c = (end[0] - start[0]) / longest
+        s = (end[1] - start[1]) / longest
+
+        # split the outline across the middle of the long axis
+        middle = (start + end) / 2.0
+        along = (outline[:, 0] - middle[0]) * c + (outline[:, 1] - middle[1]) * s
+        endArea = _clippedArea(outline, along)
+        otherArea = abs(_polygonArea(outline)) - endArea
+        if endArea < otherArea:
+            c, s = -c, -s
+
+        # flip y so that angles run counterclockwise, then land in [-180,180)
+        angle = (math.degrees(math.atan2(-s, c)) + 180) % 360 - 180
+
+        confidence = float(sweepConfidence(longest, narrowest, endArea, otherArea))
+
+        return angle, longest, confidence
+
+    def polarImage(self, bins=POLAR_BINS):
+        """My silhouette resampled around its centroid into polar coordinates,
+        as floats from 0 to 1.  There's a row for each of bins angles, starting
+        toward the right of the image and going counterclockwise, and a column
+        for each pixel of radius.  It's made once and stored."""
+        if self.polar is None or len(self.polar) != bins:
+            m00 = self.moms['m00']
+            if m00 == 0:
+                raise ArrayProcessError("I can't resample an empty silhouette around its centroid.")
+            center = (self.moms['m10'] / m00, self.moms['m01'] / m00)
+
+            # far enough to reach every corner of the array
+            radius = max(math.hypot(x - center[0], y - center[1])
+                         for x in (0, self.xdim) for y in (0, self.ydim))
+
+            polar = cv2.warpPolar(self.array, (int(math.ceil(radius)), bins), center, radius,
+                                  cv2.INTER_LINEAR + cv2.WARP_FILL_OUTLIERS + cv2.WARP_POLAR_LINEAR)
+
+            # OpenCV's angles go clockwise on screen; flip them around
+            self.polar = np.float64(polar[(-np.arange(bins)) % bins]) / 255
+
+        return self.polar
+
+    def angularProfile(self, bins=POLAR_BINS):
+        """How many pixels of my silhouette lie in each of bins equal wedges
+        around its centroid, starting toward the right of the image and going
+        counterclockwise."""
+        polar = self.polarImage(bins)
+
+        # each sample stands for a patch of the wedge as wide as its radius
+        step = 2 * math.pi / bins
+        radii = (np.arange(polar.shape[1]) + 0.5) * step
+        return polar.dot(radii)
+
+    def polarPose(self, bins=POLAR_BINS):
+        """Finds the pose from one polar resampling of the silhouette (see
+        angularProfile) and a circular correlation done with FFTs.
+
+        Without a template, the silhouette's profile is correlated with its own
+        mirror image.  That peaks at twice the angle of the axis the
+        silhouette is most nearly symmetric about, and the head is the end of
+        that axis with more of the silhouette on its side.  With a template
+        (the profile of a reference fish facing 0 degrees; see polarTemplate),
+        the profile is correlated with the template, and the peak is the
+        direction the fish is facing, head and all.
+
+        Returns (angle, confidence).  The angle follows the findLongAxis
+        convention.  The confidence is worked out like sweepConfidence's, with
+        the reach of the silhouette along and across the axis standing in for
+        the longest and shortest rows."""
+
+        polar = self.polarImage(bins)
+        profile = self.angularProfile(bins)
+        spectrum = np.fft.rfft(profile)
+        step = 360.0 / bins
 
-        # find the keys for each of the horizontal sum arrays
-        ks = list(self.horsums.keys())
+        # how far the silhouette reaches from the centroid at each angle
+        reach = np.sum(polar, axis=1)
+
+        if self.template is None:
+            # the correlation of the profile with its mirror image is its
+            # convolution with itself
+            scores = np.fft.irfft(spectrum * spectrum, bins)
+            best = int(np.argmax(scores))
+            axis = best + float(_peakOffset(scores[best - 1], scores[best],
+                                            scores[(best + 1) % bins]))
+            axis = axis / 2
+
+            # count the pixels on either side of the middle of the silhouette's
+            # reach along the axis, the way sideSums does
+            end = int(round(axis)) % bins
+            middle = (reach[end] - reach[(end + bins // 2) % bins]) / 2
+            radii = np.arange(polar.shape[1]) + 0.5
+            along = np.outer(np.cos(np.radians((np.arange(bins) - axis) * step)), radii)
+            weights = polar * (radii * math.radians(step))
+            headsum = np.sum(weights[along > middle])
+            tailsum = np.sum(weights) - headsum
+            if headsum < tailsum:
+                axis += bins / 2
+                headsum, tailsum = tailsum, headsum
+            heading = axis
+
+        else:
+            if len(self.template) != bins:
+                raise ArrayProcessError("The template has {} angles, but I'm using {}.".format(len(self.template), bins))
+
+            scores = np.fft.irfft(spectrum * np.conj(np.fft.rfft(self.template)), bins)
+            best = int(np.argmax(scores))
+            heading = best + float(_peakOffset(scores[best - 1], scores[best],
+                                               scores[(best + 1) % bins]))
+            # the head/tail decision is how much better the best match is than
+            # the same match turned end for end, measured up from the worst
+            floor = np.min(scores)
+            headsum = scores[best] - floor
+            tailsum = scores[(best + bins // 2) % bins] - floor
+
+        # how far the silhouette reaches along the axis and across it
+        along = int(round(heading)) % bins
+        across = (along + bins // 4) % bins
+        longest = reach[along] + reach[(along + bins // 2) % bins]
+        shortest = reach[across] + reach[(across + bins // 2) % bins]
+
+        angle = (heading * step + 180) % 360 - 180
+        confidence = float(sweepConfidence(longest, min(longest, shortest),
+                                           headsum, tailsum))
+
+        return angle, confidence
+
+    def fastFindLongAxis(self):
+
+        offset = int(self.momentLongAxis())
+
+        ks = [(candidate - offset) % 360 for candidate in range(0,360,90)]
 
         # find the maximum value from each horizontal sum array
-        vs = [np.amax(hs) for hs in self.horsums.values()]
+        vs = [np.amax(hs) for hs in self.computeHorsums(ks)]
 
         # and the maximum value of all of those maximums
         max_length = max(vs)
@@ -76,7 +403,79 @@ class Poser:
         return int((-angle) % 360)
 
 
-    def findLongAxis(self, samples=10, iterations=3):
+    def findLongAxis(self, samples=10, iterations=3, seedAngle=None,
+                     seedWindow=8, minConfidence=0.1, precise=False):
+        """Finds the angle the fish is facing by sweeping candidate angles for
+        the one that produces the longest row.
+
+        Normally the answer is a whole number of degrees.  With precise=True, a
+        parabola is fitted through the longest rows at the best candidate and
+        its neighbors from the sweep, and the answer is the fractional angle at
+        the top of the parabola.  That costs nothing extra.
+
+        If seedAngle is given (usually the answer for the previous frame), only
+        a narrow window of seedWindow degrees either side of it is searched.
+        If the best row in that window is at the edge of the window, or the
+        silhouette barely looks longer along the answer than across it (by
+        less than minConfidence), the full sweep is done after all."""
+
+        if self.engine in ('moment', 'calipers', 'polar'):
+            if self.engine == 'moment':
+                angle, self.confidence = self.momentPose()
+            elif self.engine == 'polar':
+                angle, self.confidence = self.polarPose()
+            else:
+                angle, self.axisLength, self.confidence = self.calipersPose()
+            if precise:
+                return angle
+            return int(round(angle) + 180) % 360 - 180
+
+        found = None
+        if seedAngle is not None:
+            found = self._warmLongAxis(seedAngle, seedWindow, minConfidence)
+
+        if found is None and self.pyramid:
+            found = self._pyramidLongAxis(samples, minConfidence)
+
+        if found is None:
+            found = self._sweepLongAxis(samples, iterations)
+
+        candidate, longest, shortest, peaks = found
+
+        if precise:
+            offset = _peakOffsetFromSweep(peaks, candidate)
+        candidate = candidate % 180
+
+        # now that we have a candidate angle, find out how much of the
+        # silhouette is on each side of the middle at that angle
+        leftsum, rightsum = self.sideSums(candidate)
+
+        self.confidence = float(sweepConfidence(longest, shortest,
+                                                leftsum, rightsum))
+
+        # if the leftsum is less than the rightsum, then the fish is facing
+        # right and not left.  Rotate it 180 degrees so it faces left.
+        if leftsum < rightsum:
+            candidate = candidate + 180 % 360
+
+        if self.engine in ('rotate', 'warp'):
+            self.rotate(candidate)
+
+        # The actual angle of the fish is the inverse of the candidate,
+        # because we rotated the whole array and then measured along one axis.
+        # This is tuned to spit out values in the half-open interval [-180,180),
+        # where 0 is toward the right side of the image.
+        angle = int((-candidate) % 360) - 180
+
+        if precise:
+            angle = (angle - offset + 180) % 360 - 180
+
+        return angle
+
+    def _sweepLongAxis(self, samples, iterations):
+        """The full sweep for findLongAxis.  Returns the candidate angle, its
+        longest row, the shortest longest-row of the sweep, and the longest
+        row at every angle tried."""
 
         #  Since we're just trying to find the angle of the axis with this
         #  method, 0-180 is sufficient.  We'll decide which direction the
@@ -90,6 +489,9 @@ class Poser:
         startAngle = 0
         stopAngle = 180 + (int(180 / samples) * 4)
 
+        # the longest row found at each candidate angle so far
+        peaks = dict()
+
         # iterations to refine the angle - we just care how many, not
         # what iteration we're actually on
         for dummy in range(iterations):
@@ -97,19 +499,15 @@ class Poser:
             stepsize = max(stepsize,1)
             # for each of the candidate angles, compute the rotated picture
             # and the horizontal sums for each line of the rotated picture
-            for angle in range(startAngle, stopAngle, stepsize):
-                self.rotate(angle)
-                self.horsum(angle)
-
-            # find the keys for each of the horizontal sum arrays
-            ks = list(self.horsums.keys())
-            # find the maximum value from each horizontal sum array
-            vs = [np.amax(hs) for hs in self.horsums.values()]
-            # and the maximum value of all of those maximums
-            max_length = max(vs[2:-2])
-            # and the candidate will be the angle that produces that
-            # maximum value
-            candidate = ks[vs.index(max_length)]
+            angles = range(startAngle, stopAngle, stepsize)
+            for angle, hs in zip(angles, self.computeHorsums(angles)):
+                peaks[angle] = np.amax(hs)
+
+            # the candidate will be the angle that produces the longest row,
+            # leaving out the overlap at each end of the sweep
+            ks = sorted(peaks.keys())
+            candidate = max(ks[2:-2], key=peaks.get)
+            shortest = min(peaks[k] for k in ks[2:-2])
 
             # at the next iteration, we'll start one stepsize before and
             # end one stepsize after the current candidate, and repartition
@@ -117,46 +515,157 @@ class Poser:
             startAngle = max(0, candidate - stepsize)
             stopAngle = min(180 + (4 * stepsize), candidate + stepsize)
 
-        # after the specified number of iterations, we will rotate the
-        # current imageframe to the candidate angle
-        frhor = self.rotate(candidate)
+        return candidate, peaks[candidate], shortest, peaks
 
-        # find the horizontal middle of the candidate-rotated image
-        mid_x = int(frhor.shape[1] / 2)
+    def _warmLongAxis(self, seedAngle, window, minConfidence):
+        """The narrow search for findLongAxis, around the axis of seedAngle."""
 
-        # find the sum of pixels on each side of that horizontal middle
-        leftsum = np.sum(frhor[:, :mid_x])
-        rightsum = np.sum(frhor[:, mid_x:])
+        # the candidate angle that findLongAxis would turn into seedAngle
+        center = int(round(-seedAngle)) % 180
 
-        # if the leftsum is less than the rightsum, then the fish is facing
-        # right and not left.  Rotate it 180 degrees so it faces left.
-        if leftsum < rightsum:
-            candidate = candidate + 180 % 360
+        return self._narrowLongAxis(center, window, minConfidence)
 
-        self.rotate(candidate)
+    def _pyramidLongAxis(self, samples, minConfidence):
+        """The coarse-to-fine search for findLongAxis.  The sweep is done on the
+        most decimated copy of the silhouette, then the answer is refined with
+        a narrow search at each finer level, ending at full resolution.
+        Returns the same things as _narrowLongAxis, or None if any level's
+        answer doesn't look trustworthy."""
 
-        # The actual angle of the fish is the inverse of the candidate,
-        # because we rotated the whole array and then measured along one axis.
-        # This is tuned to spit out values in the half-open interval [-180,180),
-        # where 0 is toward the right side of the image.
-        return int((-candidate) % 360) - 180
+        scales = [scale for scale in sorted(self.pyramid, reverse=True)
+                  if scale > 1 and min(self.ydim, self.xdim) // scale >= PYRAMID_MIN_SIZE]
+        if not scales:
+            return None
+
+        candidate, _, _, peaks = self.decimated(scales[0])._sweepLongAxis(
+            samples, self.coarseIterations)
+
+        # the first narrow search has to reach at least as far as the last
+        # step of the sweep
+        window = max(PYRAMID_WINDOW, min(abs(angle - candidate) for angle in peaks
+                                         if angle != candidate))
+
+        for scale in scales[1:] + [1]:
+            poser = self.decimated(scale) if scale > 1 else self
+            found = poser._narrowLongAxis(candidate % 180, window, minConfidence)
+            if found is None:
+                return None
+            candidate = found[0]
+            window = PYRAMID_WINDOW
+
+        return found
+
+    def decimated(self, scale):
+        """A Poser for a copy of my silhouette shrunk by the given factor.
+        They're made once and stored."""
+        if scale not in self.pyramidPosers:
+            shape = (max(1, self.xdim // scale), max(1, self.ydim // scale))
+            small = cv2.resize(self.array, shape, interpolation=cv2.INTER_AREA)
+            self.pyramidPosers[scale] = Poser(small, copyArray=False, engine=self.engine)
+
+        return self.pyramidPosers[scale]
+
+    def _narrowLongAxis(self, center, window, minConfidence):
+        """Searches for the best candidate angle within window degrees of the
+        center angle, halving the step each pass.  Returns the same things as
+        _sweepLongAxis, except that the shortest row is measured straight
+        across the answer, or None if the answer doesn't look trustworthy.
+        The candidate may be outside 0-180, and the answer is only trusted if
+        the rows are getting shorter toward both edges of the window."""
+
+        # The row sums are the same every 180 degrees, so the search can go
+        # past either end of 0-180 and ask for the sums modulo 180.
+        peaks = dict()
+        stepsize = max(1, window // 2)
+        low, high = center - window, center + window
+
+        # each edge and the angle just inside it, to tell which way the rows
+        # are heading there
+        angles = sorted(set(range(low, high + 1, stepsize)) |
+                        set([low, low + 1, high - 1, high]))
+
+        while True:
+            angles = [angle for angle in angles if angle not in peaks]
+            sums = self.computeHorsums([angle % 180 for angle in angles])
+            for angle, hs in zip(angles, sums):
+                peaks[angle] = np.amax(hs)
+
+            candidate = max(peaks, key=peaks.get)
+
+            if stepsize == 1:
+                break
+
+            # halve the step around the new candidate, staying in the window
+            stepsize = stepsize // 2
+            angles = [angle for angle in (candidate - stepsize, candidate + stepsize)
+                      if center - window <= angle <= center + window]
+
+        # The best might be outside the window if either edge is as good as
+        # the best inside it (max can pick an inside angle from a tie), or the
+        # rows are still getting longer going out past an edge.  The row
+        # lengths jitter from one degree to the next (by a pixel on a small
+        # silhouette, and more on a noisy one), which can make a bump on the
+        # way up to the real peak.  So the best is taken as the middle of it
+        # and its neighbours, and one that's close to an edge isn't trusted.
+        neighbours = [angle for angle in (candidate - 1, candidate + 1)
+                      if angle not in peaks]
+        for angle, hs in zip(neighbours, self.computeHorsums([angle % 180 for angle in neighbours])):
+            peaks[angle] = np.amax(hs)
+
+        best = sorted(peaks[angle] for angle in (candidate - 1, candidate, candidate + 1))[1]
+        margin = window // 4
+        if (peaks[low] >= best or peaks[high] >= best or
+                peaks[low] > peaks[low + 1] or peaks[high] > peaks[high - 1] or
+                candidate - low <= margin or high - candidate <= margin):
+            return None
+
+        longest = peaks[candidate]
+        across = np.amax(self.horsum((candidate + 90) % 180))
+        if 1 - across / float(max(longest, 1)) < minConfidence:
+            return None
+
+        return candidate, longest, across, peaks
 
     def _rotate(self, degrees):
-        """Use the scipy image rotation method on my array."""
+        """Use the scipy image rotation method on my array, or the rotation
+        maps for the 'warp' engine."""
+        if self.engine == 'warp':
+            return self._warpRotate(degrees)
+
         im = ndimage.interpolation.rotate(self.array, degrees % 360)
         cv2.threshold(src=im, dst=im, thresh=128, maxval=255, type=cv2.THRESH_BINARY)
         return im
 
+    def _warpRotate(self, degrees):
+        """Rotate my array with a nearest-neighbor lookup through a shared
+        rotation map.  The array is padded out to its size bucket first, so
+        the result is always a square the size of the bucket's diagonal.
+        Nothing is interpolated, so nothing needs re-thresholding."""
+        bucketY = -(-self.ydim // WARP_BUCKET) * WARP_BUCKET
+        bucketX = -(-self.xdim // WARP_BUCKET) * WARP_BUCKET
+
+        top = (bucketY - self.ydim) // 2
+        left = (bucketX - self.xdim) // 2
+        padded = cv2.copyMakeBorder(self.array, top, bucketY - self.ydim - top,
+                                    left, bucketX - self.xdim - left,
+                                    cv2.BORDER_CONSTANT, value=0)
+
+        return cv2.remap(padded, warpMap(bucketY, bucketX, degrees), None,
+                         cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT,
+                         borderValue=0)
+
     def rotate(self, degrees):
         """Caching rotation finder.  Stores the result of each rotation to
         quickly retrieve it instead of recalculating if it's needed again."""
         if type(degrees) != int:
             raise ArrayProcessError("You tried to rotate by {} degrees, but only integer angles are supported for rotation at this time.".format(degrees))
 
-        if not degrees in self.rots:
-            self.rots[degrees] = self._rotate(degrees)
+        im = self.rots.get(degrees)
+        if im is None:
+            im = self._rotate(degrees)
+            self.rots[degrees] = im
 
-        return self.rots[degrees]
+        return im
 
     def _horsum(self, arr=None):
         """Use numpy to sum along the horizontal axis of the provided array."""
@@ -172,12 +681,77 @@ class Poser:
         if type(degrees) != int:
             raise ArrayProcessError("Only integer angles are supported for horizontal sums at this time.")
 
-        if not degrees in self.horsums:
-            if not degrees in self.rots:
-                self.rotate(degrees)
-            self.horsums[degrees] = self._horsum(self.rots[degrees])
+        return self.computeHorsums([degrees])[0]
+
+    def computeHorsums(self, angles):
+        """Returns the horizontal sums for each of the angles, using stored ones
+        where possible.  The projection engine handles all of the missing
+        angles at once."""
+        found = dict()
+        for angle in angles:
+            hs = self.horsums.get(angle)
+            if hs is not None:
+                found[angle] = hs
+
+        missing = [angle for angle in angles if angle not in found]
 
-        return self.horsums[degrees]
+        if self.engine == 'projection':
+            if missing:
+                found.update(zip(missing, self._projectedHorsums(missing)))
+        else:
+            for angle in missing:
+                found[angle] = self._horsum(self.rotate(angle))
+
+        self.horsums.update([(angle, found[angle]) for angle in missing])
+
+        return [found[angle] for angle in angles]
+
+    def foregroundCoords(self):
+        """The (y, x) coordinates of the foreground pixels, measured from the
+        center of the array, which is the point that _rotate rotates around.
+        They're found once and stored."""
+        if self.coords is None:
+            ys, xs = np.nonzero(self.array)
+            self.coords = (ys - (self.ydim - 1) / 2.0,
+                           xs - (self.xdim - 1) / 2.0)
+
+        return self.coords
+
+    def _projectedHorsums(self, angles):
+        """Find the horizontal sums that _horsum would produce for the rotation
+        by each of the angles, but without rotating anything.  Each foreground
+        pixel is projected onto the vertical axis of the rotated frame and the
+        results are histogrammed, one row of bins per angle."""
+        ys, xs = self.foregroundCoords()
+        rads = np.radians(np.array(angles, dtype=np.float64) % 360)
+
+        # same sense as ndimage's rotation: positive angles are counterclockwise
+        rows = np.outer(-np.sin(rads), xs) + np.outer(np.cos(rads), ys)
+
+        # every angle gets its own run of bins, big enough for the diagonal
+        radius = int(math.ceil(math.hypot(self.ydim, self.xdim) / 2)) + 1
+        nbins = 2 * radius + 1
+        rows += (radius + np.arange(len(angles), dtype=np.float64) * nbins)[:, np.newaxis]
+
+        return list(_rowHistograms(rows, len(angles) * nbins).reshape(len(angles), nbins))
+
+    def sideSums(self, degrees):
+        """Returns the amount of silhouette on the left and right sides of the
+        middle of the silhouette after rotation by degrees."""
+        if self.engine == 'projection':
+            ys, xs = self.foregroundCoords()
+            rad = math.radians(degrees % 360)
+            cols = math.cos(rad) * xs + math.sin(rad) * ys
+            leftsum = np.count_nonzero(cols < 0)
+            return leftsum, len(cols) - leftsum
+
+        frhor = self.rotate(degrees)
+
+        # find the horizontal middle of the rotated image
+        mid_x = int(frhor.shape[1] / 2)
+
+        # find the sum of pixels on each side of that horizontal middle
+        return np.sum(frhor[:, :mid_x]), np.sum(frhor[:, mid_x:])
 
     def onScreen(self, degrees=None, scaleFactor=1):
         """I need something to display these things for debugging. This uses
@@ -206,7 +780,7 @@ class Poser:
         cv2.destroyWindow(caption)
 
 
-    def setArray(self, array, copyArray=True):
+    def setArray(self, array, copyArray=True, threshold=True):
         # It's a numpy array. Store or copy it.
         if(type(array) == np.ndarray):
             if copyArray:
@@ -224,7 +798,8 @@ class Poser:
         else:
             raise ArrayInitError("setArray requires a two-dimensional numpy array, but I see {} dimensions.".format(len(self.shape)))
 
-        cv2.threshold(src=self.array, dst=self.array, thresh=128, maxval=255, type=cv2.THRESH_BINARY)
+        if threshold:
+            cv2.threshold(src=self.array, dst=self.array, thresh=128, maxval=255, type=cv2.THRESH_BINARY)
 
     def shallowcopy(self):
         """Return a non-deep copy of this object."""
@@ -237,24 +812,364 @@ class Poser:
     def __copy__(self):
         """The actual implementation of the object shallowcopy() method.  Named so that
         the copy module can find it."""
-        newPoser = Poser(self.array, copyArray=False)
+        newPoser = Poser(self.array, copyArray=False, engine=self.engine,
+                         cacheBytes=self.rots.maxBytes, packRotations=self.rots.packBits,
+                         pyramid=self.pyramid, coarseIterations=self.coarseIterations,
+                         template=self.template)
         newPoser.rots = self.rots
         newPoser.horsums = self.horsums
+        newPoser.coords = self.coords
+        newPoser.contour = self.contour
+        newPoser.features = self.features
+        newPoser.pyramidPosers = self.pyramidPosers
+        newPoser.polar = self.polar
         return newPoser
 
     def __deepcopy__(self, memodic=None):
         """The actual implementation of the object copy() method.  Named so that
         the copy module can find it."""
-        newPoser = Poser(self.array, copyArray=True)
+        newPoser = Poser(self.array, copyArray=True, engine=self.engine,
+                         cacheBytes=self.rots.maxBytes, packRotations=self.rots.packBits,
+                         pyramid=self.pyramid, coarseIterations=self.coarseIterations,
+                         template=self.template)
         newPoser.rots = copy.deepcopy(self.rots, memodic)
-        newPoser.rots = copy.deepcopy(self.horsums, memodic)
+        newPoser.horsums = copy.deepcopy(self.horsums, memodic)
+        newPoser.coords = copy.deepcopy(self.coords, memodic)
+        newPoser.contour = copy.deepcopy(self.contour, memodic)
         return newPoser
 
-    def __init__(self, array):
-        self.setArray(array)
-        self.rots = dict()
-        self.horsums = dict()
-        self.moms = cv2.moments(self.array, binaryImage=True)
+    def __init__(self, array, copyArray=True, engine='rotate',
+                 cacheBytes=ROTATION_CACHE_BYTES, packRotations=False, contour=None,
+                 pyramid=None, coarseIterations=2, template=None):
+        if engine not in self.ENGINES:
+            raise ArrayInitError("I don't know the pose engine {}.  Choose one of: {}".format(engine, ", ".join(self.ENGINES)))
+
+        self.engine = engine
+        if isinstance(array, featurecache.FeatureCache):
+            # the mask is already binary, and mustn't be changed
+            self.features = array
+            self.setArray(array.mask(), copyArray=False, threshold=False)
+        else:
+            self.features = None
+            self.setArray(array, copyArray)
+
+        # Rotated silhouettes are kept in a bounded cache.  Rotated binary
+        # silhouettes can be stored bit-packed to fit eight times as many.
+        self.rots = arraycache.ArrayCache(cacheBytes, packBits=packRotations)
+        self.horsums = arraycache.ArrayCache(HORSUM_CACHE_BYTES)
+        self.coords = None
+        self.contour = contour
+        self.axisLength = None
+        self.confidence = None
+        if self.features is not None:
+            self.moms = self.features.moments()
+        else:
+            self.moms = cv2.moments(self.array, binaryImage=True)
+
+        self.pyramid = tuple(pyramid) if pyramid else ()
+        self.coarseIterations = coarseIterations
+        self.pyramidPosers = dict()
+
+        self.template = template
+        self.polar = None
+
+
+def polarTemplate(silhouette, angle, bins=POLAR_BINS):
+    """Makes a template for the 'polar' engine from a reference silhouette of
+    a fish facing the given angle (in the findLongAxis convention).  It's the
+    silhouette's angular profile, turned so the fish faces 0 degrees."""
+    profile = Poser(silhouette).angularProfile(bins)
+    return np.roll(profile, -int(round(angle * bins / 360.0)))
+
+
+def warpMap(ydim, xdim, degrees):
+    """The rotation map the 'warp' engine uses to rotate a ydim by xdim array
+    counterclockwise by degrees, the same way scipy's rotate does.  The output
+    is a square big enough to hold any rotation of the array.  Maps are made
+    once, in OpenCV's fixed-point format, and kept in the warpMaps cache."""
+    key = (ydim, xdim, degrees % 360)
+    map1 = warpMaps.get(key)
+    if map1 is None:
+        side = int(math.ceil(math.hypot(ydim, xdim)))
+
+        # rotate about the middle of the array, then move the middle to the
+        # middle of the output
+        matrix = cv2.getRotationMatrix2D(((xdim - 1) / 2.0, (ydim - 1) / 2.0),
+                                         degrees % 360, 1)
+        matrix[0, 2] += (side - xdim) / 2.0
+        matrix[1, 2] += (side - ydim) / 2.0
+
+        # the map says where each output pixel comes from, so it's built from
+        # the inverse transform
+        inverse = cv2.invertAffineTransform(matrix)
+        vs, us = np.mgrid[0:side, 0:side].astype(np.float32)
+        mapX = inverse[0, 0] * us + inverse[0, 1] * vs + inverse[0, 2]
+        mapY = inverse[1, 0] * us + inverse[1, 1] * vs + inverse[1, 2]
+
+        # with nearest-neighbor lookups there are no interpolation weights, so
+        # the second map is empty
+        map1, _ = cv2.convertMaps(mapX.astype(np.float32), mapY.astype(np.float32),
+                                  cv2.CV_16SC2, nninterpolation=True)
+        warpMaps[key] = map1
+
+    return map1
+
+
+def _rowHistograms(rows, length):
+    """Histograms projected row positions.  Each position in rows has already
+    been shifted into the run of bins for its histogram, so this just counts
+    them into length bins.
+
+    Each pixel is split between the two nearest rows.  Dropping pixels into the
+    nearest row alone aliases badly near multiples of 45 degrees, where the
+    pixel grid lines up with the rows unevenly."""
+    bins = np.floor(rows)
+    upper = (rows - bins).ravel()
+    bins = bins.astype(np.intp).ravel()
+
+    # the share that belongs to the next row up gets moved over by one
+    sums = np.bincount(bins, minlength=length).astype(np.float64)
+    shares = np.bincount(bins, weights=upper, minlength=length)
+    sums -= shares
+    sums[1:] += shares[:-1]
+    return sums
+
+
+def _polygonArea(points):
+    """Signed area of the polygon with the given (n x 2) vertices."""
+    xs = points[:, 0]
+    ys = points[:, 1]
+    return 0.5 * (np.dot(xs, np.roll(ys, -1)) - np.dot(ys, np.roll(xs, -1)))
+
+
+def _clippedArea(points, sides):
+    """Area of the part of the polygon where sides (a signed distance for each
+    vertex from a straight line) is positive."""
+    nextPoints = np.roll(points, -1, axis=0)
+    nextSides = np.roll(sides, -1)
+
+    keep = sides >= 0
+    crosses = keep != (nextSides >= 0)
+
+    # where each edge crosses the line, if it does
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = sides / (sides - nextSides)
+    crossings = points + (nextPoints - points) * np.where(crosses, t, 0)[:, np.newaxis]
+
+    # each kept vertex, followed by its edge's crossing if there is one
+    clipped = np.empty((2 * len(points), 2))
+    clipped[0::2] = points
+    clipped[1::2] = crossings
+    mask = np.empty(2 * len(points), bool)
+    mask[0::2] = keep
+    mask[1::2] = crosses
+
+    if np.count_nonzero(mask) < 3:
+        return 0.0
+    return abs(_polygonArea(clipped[mask]))
+
+
+def _peakOffset(below, peak, above):
+    """Where the top of the parabola through three equally spaced values is,
+    in steps from the middle one.  Kept within half a step, and zero if the
+    middle value isn't a peak.  Works elementwise on arrays, too."""
+    below = np.asarray(below, dtype=np.float64)
+    peak = np.asarray(peak, dtype=np.float64)
+    above = np.asarray(above, dtype=np.float64)
+
+    curvature = below - 2 * peak + above
+    offset = 0.5 * (below - above) / np.where(curvature < 0, curvature, -1)
+    offset = np.where(curvature < 0, offset, 0)
+    return np.clip(offset, -0.5, 0.5)
+
+
+def _peakOffsetFromSweep(peaks, candidate):
+    """The fractional part (in degrees) of the best angle of a sweep, from the
+    longest rows at the candidate and its neighbors on either side."""
+    ks = sorted(peaks.keys())
+    i = ks.index(candidate)
+    if i == 0 or i == len(ks) - 1:
+        return 0.0
+
+    below, above = ks[i - 1], ks[i + 1]
+    if candidate - below != above - candidate:
+        # uneven spacing; use the nearer neighbor's spacing on both sides
+        step = min(candidate - below, above - candidate)
+        if candidate - step not in peaks or candidate + step not in peaks:
+            return 0.0
+        below, above = candidate - step, candidate + step
+
+    return float(_peakOffset(peaks[below], peaks[candidate], peaks[above])) * (above - candidate)
+
+
+def sweepConfidence(longest, shortest, leftsum, rightsum):
+    """Confidence (from 0 to 1) in a pose found by sweeping candidate angles.
+    It's how much the longest row beats the shortest of the sweep's longest
+    rows, times how lopsided the silhouette is about its middle.  Works
+    elementwise on arrays, too."""
+    longest = np.asarray(longest, dtype=np.float64)
+    leftsum = np.asarray(leftsum, dtype=np.float64)
+    rightsum = np.asarray(rightsum, dtype=np.float64)
+
+    axisConfidence = 1 - shortest / np.maximum(longest, 1)
+    headConfidence = np.abs(leftsum - rightsum) / np.maximum(leftsum + rightsum, 1)
+
+    return axisConfidence * headConfidence
+
+
+def poseBatch(silhouettes, samples=10, iterations=3, precise=False):
+    """Finds the pose of a whole batch of binary silhouettes at once, using the
+    same projection method as Poser's 'projection' engine.  The candidate
+    angles for every silhouette in the batch are projected and histogrammed
+    together, so there's no per-silhouette overhead beyond finding its pixels.
+
+    silhouettes is either a list of two-dimensional arrays (they don't need to
+    be the same size) or a three-dimensional stack of equally-sized (padded)
+    ones; either way each one is measured from the middle of its own bounding
+    box, so padding doesn't change the answers.  Each one is thresholded the
+    way Poser does it.
+
+    Returns two arrays: the angles, following the Poser.findLongAxis
+    convention, and the confidences (see sweepConfidence).  Empty silhouettes
+    get an angle of 0 and a confidence of 0.  With precise=True, the angles
+    are fractional, as with Poser.findLongAxis.
+
+    Unlike findLongAxis, the sweep wraps around at 180 degrees (the row sums
+    don't care which way the axis points), so the refinement steps are the
+    same size for every silhouette."""
+
+    if isinstance(silhouettes, np.ndarray):
+        if silhouettes.ndim != 3:
+            raise ArrayInitError("poseBatch requires a list of arrays or a three-dimensional stack, but I see {} dimensions.".format(silhouettes.ndim))
+        count = silhouettes.shape[0]
+        owners, ys, xs = np.nonzero(silhouettes > 128)
+    else:
+        count = len(silhouettes)
+        for silhouette in silhouettes:
+            if np.ndim(silhouette) != 2:
+                raise ArrayInitError("poseBatch requires two-dimensional silhouettes, but I see {} dimensions.".format(np.ndim(silhouette)))
+        found = [np.nonzero(np.asarray(silhouette) > 128) for silhouette in silhouettes]
+        owners = np.repeat(np.arange(count), [len(f[0]) for f in found])
+        ys = np.concatenate([f[0] for f in found] + [np.zeros(0, np.intp)])
+        xs = np.concatenate([f[1] for f in found] + [np.zeros(0, np.intp)])
+
+    if count == 0:
+        return np.zeros(0, np.int32), np.zeros(0)
+
+    # Measure from the middle of each silhouette's bounding box, so padding
+    # doesn't move it.  (Poser measures from the middle of the array, which is
+    # the same thing for a silhouette cropped with the same border all round,
+    # the way Frame.applyCropToLargestBlob crops it.)  The pixels come grouped
+    # by silhouette, so each one's extent is a reduceat over its run.
+    counts = np.bincount(owners, minlength=count)
+    present = counts > 0
+    runStarts = (np.cumsum(counts) - counts)[present]
+    tops, bottoms, lefts, rights = [np.zeros(count) for dummy in range(4)]
+    if len(owners):
+        tops[present] = np.minimum.reduceat(ys, runStarts)
+        bottoms[present] = np.maximum.reduceat(ys, runStarts)
+        lefts[present] = np.minimum.reduceat(xs, runStarts)
+        rights[present] = np.maximum.reduceat(xs, runStarts)
+    ys = ys - ((tops + bottoms) / 2.0)[owners]
+    xs = xs - ((lefts + rights) / 2.0)[owners]
+
+    radius = int(math.ceil(math.hypot((bottoms - tops).max() + 1, (rights - lefts).max() + 1) / 2)) + 1
+    nbins = 2 * radius + 1
+
+    # The pixels are grouped by silhouette.  Work through them a chunk of
+    # whole silhouettes at a time; one enormous pass over every pixel of the
+    # batch is slower, because the intermediate arrays fall out of cache.
+    starts = np.concatenate([[0], np.cumsum(np.bincount(owners, minlength=count))])
+    chunks = []
+    first = 0
+    while first < count:
+        last = max(first + 1, np.searchsorted(starts, starts[first] + BATCH_CHUNK_PIXELS, 'right') - 1)
+        last = min(last, count)
+        chunks.append((first, last))
+        first = last
+
+    # where each pixel's silhouette's run of bins starts within its chunk
+    bases = np.empty(len(owners))
+    for first, last in chunks:
+        pixels = slice(starts[first], starts[last])
+        bases[pixels] = radius + (owners[pixels] - first) * nbins
+
+    stepsize = max(1, int(180 / samples))
+    offsets = np.arange(0, 180, stepsize)
+    candidates = np.zeros(count, np.int32)
+
+    for iteration in range(iterations):
+        if iteration:
+            # refine between each candidate and its neighbors from the last
+            # sweep, which we already know aren't as good
+            newStepsize = max(1, int(2 * stepsize / samples))
+            reach = ((stepsize - 1) // newStepsize) * newStepsize
+            offsets = np.arange(-reach, reach + 1, newStepsize)
+            stepsize = newStepsize
+
+        angles = candidates[:, np.newaxis] + offsets
+
+        # Turn every pixel to its silhouette's candidate angle once, then
+        # every silhouette shares the same offsets from there.
+        rads = np.radians(candidates)
+        sines = np.sin(rads)[owners]
+        cosines = np.cos(rads)[owners]
+        alongs = cosines * xs + sines * ys
+        acrosses = cosines * ys - sines * xs
+
+        rads = np.radians(offsets)
+        sines = -np.sin(rads)
+        cosines = np.cos(rads)
+
+        peaks = np.empty(angles.shape)
+        for first, last in chunks:
+            # pixels belonging to silhouettes first through last - 1
+            pixels = slice(starts[first], starts[last])
+            inChunk = last - first
+
+            # one row of positions per offset, like Poser._projectedHorsums,
+            # with a run of bins for each silhouette at each offset
+            rows = np.outer(cosines, acrosses[pixels])
+            rows += np.outer(sines, alongs[pixels])
+            rows += (np.arange(len(offsets), dtype=np.float64) * inChunk * nbins)[:, np.newaxis]
+            rows += bases[pixels]
+
+            sums = _rowHistograms(rows, len(offsets) * inChunk * nbins)
+            sums = sums.reshape(len(offsets), inChunk, nbins).max(axis=2)
+            peaks[first:last] = sums.T
+
+        best = np.argmax(peaks, axis=1)
+        candidates = angles[np.arange(count), best] % 180
+        longest = peaks[np.arange(count), best]
+        if not iteration:
+            shortest = peaks.min(axis=1)
+
+    if precise:
+        # fit through the neighbors from the last pass, where there are any
+        inside = (best > 0) & (best < len(offsets) - 1)
+        below = peaks[np.arange(count), np.maximum(best - 1, 0)]
+        above = peaks[np.arange(count), np.minimum(best + 1, len(offsets) - 1)]
+        fractions = np.where(inside, _peakOffset(below, longest, above), 0)
+        fractions *= stepsize
+
+    # head/tail: which side of the middle has more of the silhouette?
+    rads = np.radians(candidates)
+    cols = np.cos(rads)[owners] * xs + np.sin(rads)[owners] * ys
+    leftsum = np.bincount(owners, weights=cols < 0, minlength=count)
+    rightsum = np.bincount(owners, minlength=count) - leftsum
+
+    candidates[leftsum < rightsum] += 180
+
+    angles = (-candidates) % 360 - 180
+    if precise:
+        angles = (angles - fractions + 180) % 360 - 180
+    confidences = sweepConfidence(longest, shortest, leftsum, rightsum)
+
+    empty = (leftsum + rightsum) == 0
+    angles[empty] = 0
+    confidences[empty] = 0
+
+    return angles, confidences
 
 # Definitions of custom exceptions
 
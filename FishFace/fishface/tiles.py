@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+The tiles module provides tiles.TileExecutor, which runs an image operation on
+horizontal bands of a large image at the same time, on a pool of threads.
+OpenCV lets go of the GIL while it works, so the bands really do run in
+parallel.  A Frame given a TileExecutor uses it for its per-pixel stages.
+"""
+
+import multiprocessing.pool
+
+try:
+    import numpy as np
+    import cv2
+except ImportError:
+    print "The tiles module needs numpy and OpenCV."
+    raise
+
+# Images with fewer pixels than this aren't worth splitting up, and no band is
+# made thinner than this many rows.
+MIN_PIXELS = 2 ** 19
+MIN_BAND_ROWS = 64
+
+
+class TileExecutor:
+    """
+Splits images into horizontal bands and runs an operation on all of them at
+once.  Things to know:
+    * run(operation, sources, dst, halo) calls operation(sourceBands, dstBand)
+      once per band, where sourceBands is a list of the matching bands of each
+      of the sources (which must all be the same height) and dstBand is the
+      band of dst to write to.  operation must write its result to dstBand, or
+      if dstBand is None, return its result as a new array the size of the
+      source bands.
+    * halo is how many rows on either side of a band the operation needs to
+      see, e.g. the kernel radius of a dilation.  With a halo, each source band
+      takes in that many extra rows from its neighbors (none past the edges of
+      the image, so the borders are handled the way the operation would handle
+      them on the whole image) and the result for the extra rows is thrown
+      away.  The result is the same as running the operation on the whole
+      image.
+    * Images smaller than minPixels are run in one piece, on the calling
+      thread.
+    * OpenCV has threads of its own for some operations; if both are busy
+      there may be more threads than cores (see cv2.setNumThreads).
+"""
+
+    def __init__(self, threads=None, minPixels=MIN_PIXELS, minBandRows=MIN_BAND_ROWS):
+        if threads is None:
+            threads = cv2.getNumberOfCPUs()
+
+        self.threads = max(1, threads)
+        self.minPixels = minPixels
+        self.minBandRows = minBandRows
+        self.pool = None
+
+    def bands(self, rows):
+        """The (first, last) rows (last not included) of each band of an image
+        with the given number of rows."""
+        count = max(1, min(self.threads, rows // self.minBandRows))
+        edges = [rows * i // count for i in range(count + 1)]
+        return zip(edges[:-1], edges[1:])
+
+    def run(self, operation, sources, dst, halo=0):
+        """Run operation on dst in bands (see above), and return dst."""
+        rows = dst.shape[0]
+        if self.threads < 2 or rows * dst.shape[1] < self.minPixels:
+            operation(sources, dst)
+            return dst
+
+        if self.pool is None:
+            self.pool = multiprocessing.pool.ThreadPool(self.threads)
+
+        bands = self.bands(rows)
+
+        # When dst is one of the sources, a band with a halo can't be written
+        # until its neighbors have finished reading from it.
+        inPlace = halo and any(np.may_share_memory(source, dst) for source in sources)
+        if inPlace:
+            results = self.pool.map(lambda band: self._computeBand(operation, sources, halo, band), bands)
+            for (first, last), result in zip(bands, results):
+                np.copyto(dst[first:last], result)
+        else:
+            self.pool.map(lambda band: self._runBand(operation, sources, dst, halo, band), bands)
+
+        return dst
+
+    def _computeBand(self, operation, sources, halo, band):
+        first, last = band
+        top = max(0, first - halo)
+        bottom = min(sources[0].shape[0], last + halo)
+        result = operation([source[top:bottom] for source in sources], None)
+        return result[first - top:last - top]
+
+    def _runBand(self, operation, sources, dst, halo, band):
+        first, last = band
+        if halo:
+            np.copyto(dst[first:last], self._computeBand(operation, sources, halo, band))
+        else:
+            operation([source[first:last] for source in sources], dst[first:last])
+
+    def close(self):
+        """Shut down the threads."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __deepcopy__(self, memodic=None):
+        # the threads are shared, not copied
+        return self